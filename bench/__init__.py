@@ -0,0 +1,3 @@
+"""Throughput and latency benchmarks of pipeteer's pipelines. Run `python -m bench --help`"""
+from .harness import Config, Record, BENCHMARKS, benchmark
+from . import activity, task, workflow, multitask
@@ -0,0 +1,76 @@
+from dataclasses import asdict
+from datetime import datetime
+import argparse
+import asyncio
+import importlib.metadata
+import json
+import platform
+import sys
+import warnings
+from sqlalchemy.exc import SAWarning
+from . import Config, BENCHMARKS
+
+def version() -> str:
+  try:
+    return importlib.metadata.version('pipeteer')
+  except importlib.metadata.PackageNotFoundError:
+    return 'unknown'
+
+async def run(names: list[str], cfg: Config, out: str):
+  results = []
+  for name in names:
+    async for record in BENCHMARKS[name](cfg):
+      print(f'{record.bench} {record.params}: ' + ', '.join(f'{k}={v:.4g}' for k, v in record.metrics.items()), file=sys.stderr)
+      results.append(asdict(record))
+
+  report = dict(
+    pipeteer=version(), python=platform.python_version(), platform=platform.platform(),
+    timestamp=datetime.now().isoformat(), quick=cfg.quick, results=results,
+  )
+  with open(out, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(f'Results written to {out}', file=sys.stderr)
+
+def compare(old_path: str, new_path: str):
+  """Print each metric of `new` relative to `old`, for the benchmarks both ran with the same parameters"""
+  with open(old_path) as f:
+    old = json.load(f)
+  with open(new_path) as f:
+    new = json.load(f)
+  key = lambda r: (r['bench'], json.dumps(r['params'], sort_keys=True))
+  before = { key(r): r['metrics'] for r in old['results'] }
+  print(f'{old["pipeteer"]} -> {new["pipeteer"]}')
+  for r in new['results']:
+    if (prev := before.get(key(r))) is None:
+      continue
+    print(f'{r["bench"]} {r["params"]}')
+    for metric, value in r['metrics'].items():
+      if (was := prev.get(metric)):
+        print(f'  {metric}: {was:.4g} -> {value:.4g} ({value / was:.2f}x)')
+
+def main():
+  parser = argparse.ArgumentParser(prog='python -m bench', description='Benchmark pipeteer pipelines')
+  sub = parser.add_subparsers(dest='command')
+
+  run_parser = sub.add_parser('run', help='Run benchmarks (default command)')
+  run_parser.add_argument('names', nargs='*', help=f'Benchmarks to run (default: all): {", ".join(BENCHMARKS)}')
+  run_parser.add_argument('-o', '--out', default='bench.json', help='Results file (JSON)')
+  run_parser.add_argument('-q', '--quick', action='store_true', help='Fewer items and parameters')
+  run_parser.add_argument('-s', '--storage', choices=['file', 'memory'], action='append', help='SQLite on disk and/or in /dev/shm (default: both)')
+
+  compare_parser = sub.add_parser('compare', help='Compare two results files')
+  compare_parser.add_argument('old')
+  compare_parser.add_argument('new')
+
+  args = parser.parse_args(sys.argv[1:] if sys.argv[1:2] in (['run'], ['compare'], ['-h'], ['--help']) else ['run', *sys.argv[1:]])
+  if args.command == 'compare':
+    compare(args.old, args.new)
+  else:
+    if (unknown := set(args.names) - set(BENCHMARKS)):
+      parser.error(f'Unknown benchmarks: {", ".join(unknown)}')
+    warnings.filterwarnings('ignore', category=SAWarning) # each benchmark re-creates the same tables, on a fresh DB
+    cfg = Config(quick=args.quick, storage=args.storage or ['file', 'memory'])
+    asyncio.run(run(args.names or list(BENCHMARKS), cfg, args.out))
+
+if __name__ == '__main__':
+  main()
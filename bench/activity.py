@@ -0,0 +1,53 @@
+from datetime import timedelta
+import time
+from pipeteer import activity
+from .harness import Config, Record, benchmark, context, running, drain, wait_key, percentiles, payload, rate
+
+async def echo(x: str) -> str:
+  return x
+
+def echo_activity(**kwargs):
+  return activity('echo', poll_interval=timedelta(seconds=1), **kwargs)(echo)
+
+@benchmark('activity-throughput')
+async def throughput(cfg: Config):
+  """Items/s of an activity draining a pre-filled queue"""
+  n = cfg.pick([500], [5000])[0]
+  for storage in cfg.storage:
+    for size in cfg.pick([100], [100, 10_000]):
+      for concurrency in cfg.pick([1, 8], [1, 8, 32]):
+        for claim_batch in cfg.pick([1, 16], [1, 16]):
+          pipe = echo_activity(max_concurrency=concurrency, claim_batch=claim_batch)
+          async with context(storage) as ctx:
+            x = payload(size)
+            await pipe.push_many(ctx, ((f'{i:08}', x) for i in range(n)))
+            start = time.perf_counter()
+            async with running(ctx, pipe):
+              await drain(ctx, pipe, n)
+            elapsed = time.perf_counter() - start
+
+          params = dict(storage=storage, payload=size, concurrency=concurrency, claim_batch=claim_batch)
+          yield Record('activity-throughput', params, rate(n, elapsed))
+
+@benchmark('activity-latency')
+async def latency(cfg: Config):
+  """Latency of a single hop (push -> output notification) of an idle activity, per notification transport.
+  `'tcp'` goes through a native proxy running in-process"""
+  n = cfg.pick([50], [500])[0]
+  pipe = echo_activity()
+  for storage in cfg.storage:
+    for transport in ('local', 'inproc', 'tcp'):
+      async with context(storage, transport) as ctx:
+        async with running(ctx, pipe):
+          ctx.zmq.sub('output') # subscribe before pushing
+          await pipe.push_many(ctx, [('warmup', 'x')])
+          await wait_key(ctx, 'warmup', timeout=10)
+          times = []
+          for i in range(n):
+            start = time.perf_counter()
+            await pipe.push_many(ctx, [(f'{i:08}', 'x')])
+            await wait_key(ctx, f'{i:08}')
+            times.append(time.perf_counter() - start)
+
+      metrics = percentiles(times, 50, 95, 99) | dict(mean=sum(times) / n)
+      yield Record('activity-latency', dict(storage=storage, transport=transport), metrics)
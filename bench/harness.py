@@ -0,0 +1,123 @@
+from typing_extensions import Literal, TypeVar, Callable, AsyncIterator, Any, Sequence
+from dataclasses import dataclass
+from contextlib import asynccontextmanager
+import asyncio
+import os
+import socket
+import tempfile
+import time
+from sqlalchemy import func
+from sqlmodel import select, Session
+from dslog import Logger
+from pipeteer import DB, Context
+from pipeteer.backend import native_proxy, Transport
+from pipeteer.pipelines import Runnable, Inputtable
+
+T = TypeVar('T')
+Storage = Literal['file', 'memory']
+
+@dataclass
+class Config:
+  """
+  - `quick`: fewer items and parameters, for a smoke run
+  - `storage`: SQLite on disk (`'file'`) and/or on a RAM-backed filesystem (`'memory'`, i.e. `/dev/shm`)
+  """
+  quick: bool = False
+  storage: Sequence[Storage] = ('file', 'memory')
+
+  def pick(self, quick: Sequence[T], full: Sequence[T]) -> Sequence[T]:
+    return quick if self.quick else full
+
+@dataclass
+class Record:
+  bench: str
+  params: dict[str, Any]
+  metrics: dict[str, float]
+
+Benchmark = Callable[[Config], AsyncIterator[Record]]
+BENCHMARKS: dict[str, Benchmark] = {}
+
+def benchmark(name: str):
+  def decorator(fn: Benchmark) -> Benchmark:
+    BENCHMARKS[name] = fn
+    return fn
+  return decorator
+
+
+def _free_port() -> int:
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def _tmpdir(storage: Storage) -> str | None:
+  if storage == 'memory':
+    if not os.path.isdir('/dev/shm'):
+      raise RuntimeError('In-memory storage needs a RAM-backed /dev/shm')
+    return '/dev/shm'
+
+@asynccontextmanager
+async def context(storage: Storage, transport: Transport = 'local', **db_kwargs) -> AsyncIterator[Context]:
+  """A fresh SQLite DB in a temporary directory, plus the proxy (if any) running in-process"""
+  with tempfile.TemporaryDirectory(prefix='pipeteer-bench-', dir=_tmpdir(storage)) as dir:
+    db = DB.at(os.path.join(dir, 'bench.db'), **db_kwargs)
+    tasks = []
+    if transport == 'tcp':
+      pub, sub = _free_port(), _free_port()
+      ctx = Context.of(db, log=Logger.empty(), pub_url=f'tcp://127.0.0.1:{pub}', sub_url=f'tcp://127.0.0.1:{sub}')
+      tasks.append(asyncio.create_task(native_proxy(f'tcp://127.0.0.1:{pub}', f'tcp://127.0.0.1:{sub}')))
+      await asyncio.sleep(0.2) # let the sockets connect
+    else:
+      ctx = Context.of(db, log=Logger.empty(), transport=transport)
+    try:
+      yield ctx
+    finally:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+      db.engine.dispose()
+
+@asynccontextmanager
+async def running(ctx: Context, *pipelines: Runnable):
+  tasks = [asyncio.create_task(pipe.run(ctx)) for pipe in pipelines]
+  await asyncio.sleep(0.05) # subscribe before anything is pushed
+  try:
+    yield
+  finally:
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def count(ctx: Context, Table) -> int:
+  with Session(ctx.db.engine) as s:
+    return s.exec(select(func.count()).select_from(Table)).one()
+
+async def drain(ctx: Context, pipe: Inputtable, n: int, *, table: str = 'output', timeout: float = 600):
+  """Wait until `table` holds `n` outputs of `pipe`"""
+  Output = pipe.output(ctx, table)
+  sub = ctx.zmq.sub(table)
+  deadline = time.perf_counter() + timeout
+  while await ctx.db.run(count, ctx, Output) < n:
+    if time.perf_counter() > deadline:
+      raise TimeoutError(f'Only {count(ctx, Output)}/{n} outputs after {timeout}s')
+    try:
+      await asyncio.wait_for(sub.wait(), 0.05)
+    except asyncio.TimeoutError:
+      ...
+
+async def wait_key(ctx: Context, key: str, *, table: str = 'output', timeout: float = 60):
+  """Wait for the notification of `key` being written to `table`"""
+  sub = ctx.zmq.sub(table)
+  async def wait():
+    while key not in await sub.wait():
+      ...
+  await asyncio.wait_for(wait(), timeout)
+
+def percentiles(xs: Sequence[float], *ps: float) -> dict[str, float]:
+  xs = sorted(xs)
+  return { f'p{p:g}': xs[min(len(xs)-1, int(p/100 * len(xs)))] for p in ps }
+
+def payload(size: int) -> str:
+  return 'x' * size
+
+def rate(n: int, elapsed: float) -> dict[str, float]:
+  return dict(items=n, seconds=elapsed, items_per_s=n / elapsed)
@@ -0,0 +1,32 @@
+from datetime import timedelta
+import asyncio
+import time
+from pipeteer import activity, multitask
+from .harness import Config, Record, benchmark, context, running, drain, payload, rate
+
+async def echo(x: str) -> str:
+  return x
+
+def composed(k: int):
+  pipes = [activity(f'echo-{i}', poll_interval=timedelta(seconds=1), max_concurrency=8, claim_batch=16)(echo) for i in range(k)]
+  @multitask(*pipes, id='composed')
+  async def run(*coros, ctx):
+    await asyncio.gather(*coros)
+  return run
+
+@benchmark('multitask')
+async def composition(cfg: Config):
+  """Total items/s of `k` activities composed into a single `MultiTask`, sharing the event loop and DB"""
+  n = cfg.pick([200], [2000])[0]
+  for storage in cfg.storage:
+    for k in cfg.pick([1, 4], [1, 2, 4, 8]):
+      multi = composed(k)
+      async with context(storage) as ctx:
+        for pipe in multi.pipelines:
+          await pipe.push_many(ctx, ((f'{i:08}', payload(100)) for i in range(n)), output=f'output-{pipe.id}') # type: ignore
+        start = time.perf_counter()
+        async with running(ctx, multi):
+          await asyncio.gather(*(drain(ctx, pipe, n, table=f'output-{pipe.id}') for pipe in multi.pipelines)) # type: ignore
+        elapsed = time.perf_counter() - start
+
+      yield Record('multitask', dict(storage=storage, pipelines=k), rate(k * n, elapsed))
@@ -0,0 +1,29 @@
+import time
+from pipeteer import task, Context, InputT, Push
+from .harness import Config, Record, benchmark, context, payload, rate, count
+
+@task('copy')
+async def copy_each(Input: type[InputT[str]], push: Push[str], ctx: Context):
+  async for it in copy_each.items(ctx):
+    await push(it.key, it.value)
+
+@task('copy')
+async def copy_many(Input: type[InputT[str]], push: Push[str], ctx: Context):
+  await push.many([(it.key, it.value) async for it in copy_many.items(ctx)])
+
+@benchmark('task-push')
+async def push_rate(cfg: Config):
+  """Outputs/s pushed by a task, one by one (`push`) vs in bulk (`push.many`)"""
+  for storage in cfg.storage:
+    for size in cfg.pick([100], [100, 10_000]):
+      for mode, pipe in [('each', copy_each), ('many', copy_many)]:
+        n = cfg.pick([500], [2000 if mode == 'each' else 20_000])[0]
+        async with context(storage) as ctx:
+          x = payload(size)
+          await pipe.push_many(ctx, ((f'{i:08}', x) for i in range(n)))
+          start = time.perf_counter()
+          await pipe.run(ctx)
+          elapsed = time.perf_counter() - start
+          assert count(ctx, pipe.output(ctx)) == n
+
+        yield Record('task-push', dict(storage=storage, payload=size, mode=mode), rate(n, elapsed))
@@ -0,0 +1,65 @@
+from datetime import timedelta
+import time
+from pipeteer import activity, workflow, WorkflowContext
+from .harness import Config, Record, benchmark, context, running, drain, rate
+
+@activity('inc', poll_interval=timedelta(seconds=1), max_concurrency=8, claim_batch=8)
+async def inc(x: int) -> int:
+  return x + 1
+
+def chain(steps: int, **kwargs):
+  @workflow(id='chain', poll_interval=timedelta(seconds=1), claim_batch=8, **kwargs)
+  async def chain(x: int, ctx: WorkflowContext) -> int:
+    for _ in range(steps):
+      x = await ctx.call(inc, x)
+    return x
+  return chain
+
+@benchmark('workflow-replay')
+async def replay(cfg: Config):
+  """Workflows/s of a chain of `steps` activity calls. Each result replays the workflow from the start,
+  so without `replay_cache` the cost per step grows with the step count"""
+  n = cfg.pick([10], [50])[0]
+  for storage in cfg.storage:
+    for steps in cfg.pick([1, 8], [1, 4, 16, 32]):
+      for replay_cache in (0, 64):
+        for state_storage in cfg.pick(['rows'], ['rows', 'packed']):
+          pipe = chain(steps, replay_cache=replay_cache, state_storage=state_storage)
+          async with context(storage) as ctx:
+            await pipe.push_many(ctx, ((f'{i:08}', i) for i in range(n)))
+            start = time.perf_counter()
+            async with running(ctx, pipe, inc):
+              await drain(ctx, pipe, n)
+            elapsed = time.perf_counter() - start
+
+          params = dict(storage=storage, steps=steps, replay_cache=replay_cache, state_storage=state_storage)
+          metrics = rate(n, elapsed) | dict(ms_per_step=1e3 * elapsed / (n * steps))
+          yield Record('workflow-replay', params, metrics)
+
+def fanout(n: int, mode: str):
+  @workflow(id='fanout', poll_interval=timedelta(seconds=1), claim_batch=64)
+  async def fanout(x: int, ctx: WorkflowContext) -> int:
+    if mode == 'map':
+      ys = await ctx.map(inc, range(n))
+    else:
+      ys = await ctx.all(*(ctx.call(inc, i) for i in range(n)))
+    return sum(ys)
+  return fanout
+
+@benchmark('workflow-fanout')
+async def fan(cfg: Config):
+  """Branches/s of a workflow fanning out to `branches` activity calls and collecting their results,
+  with `ctx.all` (over a coroutine per call) or `ctx.map`. Both enqueue all calls in a single transaction"""
+  for storage in cfg.storage:
+    for n in cfg.pick([200], [200, 2000]):
+      for mode in ('all', 'map'):
+        pipe = fanout(n, mode)
+        async with context(storage) as ctx:
+          await pipe.push_many(ctx, [('fan', 0)])
+          start = time.perf_counter()
+          async with running(ctx, pipe, inc):
+            await drain(ctx, pipe, 1)
+          elapsed = time.perf_counter() - start
+
+        params = dict(storage=storage, branches=n, mode=mode)
+        yield Record('workflow-fanout', params, rate(n, elapsed))
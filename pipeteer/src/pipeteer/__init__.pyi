@@ -1,7 +1,7 @@
 from .backend import DB, ZMQ
 from .pipelines import (
   Context, Input, InputT, Entry, EntryT,
-  activity, workflow, WorkflowContext, task, Push, multitask
+  activity, workflow, WorkflowContext, task, Push, multitask, run
 )
 
 __all__ = [
@@ -10,4 +10,5 @@ __all__ = [
   'activity',
   'workflow', 'WorkflowContext',
   'task', 'Push', 'multitask',
+  'run',
 ]
\ No newline at end of file
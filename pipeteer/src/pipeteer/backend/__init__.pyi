@@ -1,4 +1,12 @@
-from .db import DB
-from .zmq import ZMQ, Pub, Sub, proxy
+from .db import DB, SQLITE_PRAGMAS
+from .codec import Codec, CodecFormat
+from .zmq import ZMQ, Pub, Sub, Dispatcher, DispatchedSub, proxy, native_proxy, ProxyMode
+from .metrics import Metrics, NoMetrics, Registry, METRICS
+from .profiler import Profiler, tagged
+from .notifier import Notifier, Publisher, Subscriber, Transport, Local, LocalPub, LocalSub, CoalescingPub
 
-__all__ = ['DB', 'Pub', 'Sub', 'proxy', 'ZMQ']
\ No newline at end of file
+__all__ = [
+  'DB', 'SQLITE_PRAGMAS', 'Codec', 'CodecFormat', 'Pub', 'Sub', 'Dispatcher', 'DispatchedSub', 'proxy', 'native_proxy', 'ProxyMode', 'ZMQ',
+  'Notifier', 'Publisher', 'Subscriber', 'Transport', 'Local', 'LocalPub', 'LocalSub', 'CoalescingPub',
+  'Metrics', 'NoMetrics', 'Registry', 'METRICS', 'Profiler', 'tagged',
+]
\ No newline at end of file
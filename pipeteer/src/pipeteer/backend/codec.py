@@ -0,0 +1,107 @@
+from typing_extensions import Any, Literal, Callable, Union, get_origin, get_args
+from dataclasses import dataclass
+from functools import lru_cache
+from types import UnionType, NoneType
+import importlib
+from sqlalchemy import LargeBinary, TypeDecorator
+from pydantic import TypeAdapter
+import pydantic_core
+
+CodecFormat = Literal['json', 'orjson', 'msgpack']
+
+_MODULES = { 'orjson': 'orjson', 'msgpack': 'msgpack' }
+_PRIMITIVES = (str, int, float, bool, NoneType)
+
+def _json_native(T) -> bool:
+  """Whether decoded JSON already is a valid `T`, with no validation needed (`Any`, primitives, and lists, str-keyed dicts and optionals of them)"""
+  if T is Any or T in _PRIMITIVES:
+    return True
+  origin, args = get_origin(T), get_args(T)
+  if origin is list:
+    return all(_json_native(a) for a in args)
+  if origin is dict:
+    return not args or (args[0] is str and _json_native(args[1]))
+  if origin is Union or origin is UnionType:
+    return all(_json_native(a) for a in args)
+  return False
+
+def _cached(fn):
+  """`lru_cache` for hashable arguments, plain calls otherwise"""
+  cached = lru_cache(maxsize=None)(fn)
+  def wrapper(*args):
+    try:
+      return cached(*args)
+    except TypeError: # unhashable
+      return fn(*args)
+  return wrapper
+
+@_cached
+def adapter(T) -> TypeAdapter:
+  return TypeAdapter(T)
+
+@dataclass(frozen=True)
+class Codec:
+  """Encoding of value columns, stored as bytes in a binary column
+  - `format`:
+    - `'json'`: pydantic's native JSON encoder/parser (no extra dependency)
+    - `'orjson'`: [orjson](https://github.com/ijl/orjson) (`pip install orjson`)
+    - `'msgpack'`: [msgpack](https://msgpack.org) (`pip install msgpack`)
+  - `trusted`: values are only written by pipeteer, with their declared type. So, for JSON-native types (primitives, lists, dicts), they're decoded without validation.
+    Other types (e.g. pydantic models) are still validated, in a single pass over the bytes with `'json'`
+  """
+  format: CodecFormat = 'json'
+  trusted: bool = False
+
+  def __post_init__(self):
+    if self.format not in ('json', 'orjson', 'msgpack'):
+      raise ValueError(f'Unknown codec format: "{self.format}"')
+    if (module := _MODULES.get(self.format)) is not None:
+      try:
+        importlib.import_module(module)
+      except ImportError as e:
+        raise ImportError(f'The "{self.format}" codec requires `{module}`: `pip install {module}`') from e
+
+  def dumps(self, T) -> Callable[[Any], bytes]:
+    Type = adapter(T)
+    if self.format == 'json':
+      return Type.dump_json
+    lib = importlib.import_module(_MODULES[self.format])
+    pack = lib.dumps if self.format == 'orjson' else lib.packb
+    if self.trusted and _json_native(T):
+      return pack
+    return lambda x: pack(Type.dump_python(x, mode='json'))
+
+  def loads(self, T) -> Callable[[bytes], Any]:
+    Type = adapter(T)
+    native = self.trusted and _json_native(T)
+    if self.format == 'json':
+      return pydantic_core.from_json if native else Type.validate_json
+    lib = importlib.import_module(_MODULES[self.format])
+    unpack = lib.loads if self.format == 'orjson' else lib.unpackb
+    if native:
+      return unpack
+    return lambda b: Type.validate_python(unpack(b))
+
+  def column(self, T) -> type[TypeDecorator]:
+    """Column type storing `T`s encoded with this codec"""
+    return _column(self, T)
+
+
+@_cached
+def _column(codec: Codec, T) -> type[TypeDecorator]:
+  dumps, loads = codec.dumps(T), codec.loads(T)
+
+  class Encoded(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+      if value is not None:
+        return dumps(value)
+
+    def process_result_value(self, value, dialect):
+      if value is not None:
+        return loads(value)
+
+  Encoded.__name__ = f'Encoded{codec.format.capitalize()}{"Trusted" if codec.trusted else ""}'
+  return Encoded
@@ -1,42 +1,151 @@
-from typing_extensions import TypeVar
+from typing_extensions import TypeVar, Hashable, Callable, Mapping, Any
 from dataclasses import dataclass, field, replace
-from sqlalchemy import Engine
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import atexit
+import contextvars
+import os
+import threading
+import weakref
+from sqlalchemy import Engine, event, make_url
+from sqlalchemy.pool import StaticPool, SingletonThreadPool
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql.schema import MetaData
 from sqlmodel import SQLModel, create_engine, Session
+from .codec import Codec, CodecFormat
+from .profiler import Profiler, tagged
 
 T = TypeVar('T', bound=SQLModel)
+R = TypeVar('R')
+_lock = threading.Lock() # models are created on the shared `SQLModel.metadata`
+_executors: 'weakref.WeakKeyDictionary[Engine, tuple[int, dict[str, ThreadPoolExecutor]]]' = weakref.WeakKeyDictionary() # engine -> (pid, executors)
+_executors_lock = threading.Lock()
+
+SQLITE_PRAGMAS: Mapping[str, Any] = {
+  'journal_mode': 'WAL', # readers and the writer don't block each other
+  'synchronous': 'NORMAL', # durable enough with WAL, without a sync per commit
+  'busy_timeout': 5000, # ms waiting for a lock before failing with "database is locked"
+  'mmap_size': 256 * 2**20,
+  'cache_size': -64 * 2**10, # KiB
+}
 
 @dataclass
 class DB:
+  """
+  - `codec`: how pipelines store values. `None` (default) uses JSON columns; a `Codec` (or its format) encodes them into binary columns.
+    Existing tables keep the column type they were created with, so pick it upfront
+  - `workers`: threads running the pipelines' DB work (see `run`). A single one for in-memory SQLite, whose connection is shared
+  - `single_writer`: run all writes of this process on a single thread (see `write`)
+  """
   engine: Engine
   metadata: MetaData = MetaData()
-  tables: dict[str, type] = field(default_factory=dict)
+  tables: dict[Hashable, type] = field(default_factory=dict)
   prefix_: str = ''
+  codec: Codec | None = None
+  workers: int = 4
+  single_writer: bool = False
+
+  def __post_init__(self):
+    if isinstance(self.codec, str):
+      self.codec = Codec(self.codec)
 
   def prefix(self, prefix: str, /):
     return replace(self, prefix_=prefix)
 
   @classmethod
-  def of(cls, db_url: str, /):
-    return cls(create_engine(db_url))
+  def of(
+    cls, db_url: str, /, *, codec: Codec | CodecFormat | None = None,
+    workers: int = 4, single_writer: bool = False, **engine_kwargs
+  ):
+    """- `engine_kwargs`: passed to `create_engine`
+    - In-memory SQLite (e.g. `'sqlite://'`) shares a single connection (thus, a single database) across the DB's threads
+    """
+    if _in_memory(db_url) and 'poolclass' not in engine_kwargs:
+      engine_kwargs = dict(poolclass=StaticPool, connect_args=dict(check_same_thread=False)) | engine_kwargs
+    engine = create_engine(db_url, **engine_kwargs)
+    return cls(engine, codec=codec, workers=workers, single_writer=single_writer) # type: ignore
 
   @classmethod
-  def at(cls, sqlite_path: str, /):
-    import os
+  def at(
+    cls, sqlite_path: str, /, *, codec: Codec | CodecFormat | None = None,
+    pragmas: Mapping[str, Any] | None = SQLITE_PRAGMAS,
+    workers: int = 4, single_writer: bool = False,
+  ):
+    """SQLite DB at `sqlite_path`
+    - `pragmas`: set on every connection. Defaults to `SQLITE_PRAGMAS`, a profile for concurrent workers (WAL, `synchronous=NORMAL`, a 5s `busy_timeout`, mmap). `None` keeps SQLite's defaults
+    - The connection pool keeps a connection per DB thread (see `workers`), the writer's and one for the event loop (e.g. DDL), with up to 10 more (SQLAlchemy's default overflow) for the application's own sessions
+    """
     dir = os.path.dirname(sqlite_path)
     if dir:
       os.makedirs(dir, exist_ok=True)
-    return cls.of(f'sqlite:///{sqlite_path}')
+    db = cls.of(
+      f'sqlite:///{sqlite_path}', codec=codec, workers=workers, single_writer=single_writer,
+      pool_size=workers+2, max_overflow=10,
+    )
+    if pragmas:
+      event.listen(db.engine, 'connect', _set_pragmas(pragmas))
+    return db
   
   @property
   def session(self):
     return Session(self.engine)
+  
+  def _executor(self, name: str, workers: int) -> ThreadPoolExecutor:
+    """Executor `name` of the engine, shared by all `DB`s on it (e.g. `prefix` copies), so that there's a single writer thread per engine and process"""
+    with _executors_lock:
+      pid, executors = _executors.get(self.engine, (None, {}))
+      if pid != os.getpid(): # threads don't survive a fork
+        executors = {}
+        _executors[self.engine] = os.getpid(), executors
+      if name not in executors:
+        executors[name] = ThreadPoolExecutor(workers, thread_name_prefix=f'pipeteer-{name}')
+      return executors[name]
+  
+  async def run(self, fn: Callable[..., R], *args) -> R:
+    """Run blocking DB work `fn(*args)` on the DB's threads (with the caller's context variables), so that waiting on the DB doesn't block the event loop
+    - A `Session` may be passed across calls, as long as they're awaited one at a time
+    """
+    pool = self.engine.pool
+    if isinstance(pool, SingletonThreadPool):
+      return fn(*args) # a connection (and, in memory, a database) per thread: stay on the caller's
+    workers = 1 if isinstance(pool, StaticPool) else self.workers
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(self._executor('db', workers), ctx.run, fn, *args)
+  
+  def profile(self, profiler: Profiler | None = None, *, at_exit: bool = False) -> Profiler:
+    """Start recording the time spent by each statement, tagged by pipeline and phase (see `Profiler`)
+    - `at_exit`: print the report to stderr when the process exits
+    """
+    profiler = profiler or Profiler()
+    profiler.attach(self.engine)
+    if at_exit:
+      atexit.register(profiler.dump)
+    return profiler
+
+  async def write(self, fn: Callable[..., R], *args) -> R:
+    """Like `run`, for work that writes. With `single_writer`, it all runs on one thread,
+    so that writers of this process take turns instead of contending for the DB's lock
+    """
+    if not self.single_writer or isinstance(self.engine.pool, (SingletonThreadPool, StaticPool)):
+      return await self.run(fn, *args)
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(self._executor('db-writer', 1), ctx.run, fn, *args)
 
   def table(self, name: str, type: type[T], /) -> type[T]:
+    """Table model `name` (prefixed) with the fields of `type`. Created once per process, then cached
+    - Cached by name and field types, so that fresh (but equal) model classes like `Entry(int)` hit the cache
+    """
     name = self.prefix_ + name
-    # if name in self.tables:
-    #   return self.tables[name]
+    key = _cache_key(name, type)
+    if key is not None and (cached := self.tables.get(key)) is not None:
+      return cached # type: ignore
+    
+    with _lock: # tables may be requested from the DB threads too
+      if key is not None and (cached := self.tables.get(key)) is not None:
+        return cached # type: ignore
+      return self._create(name, key, type)
+
+  def _create(self, name: str, key: Hashable | None, type: type[T]) -> type[T]:
     class _Cls(type, table=True):
       __tablename__ = name # type: ignore
     _Cls.__name__ = type.__name__
@@ -44,10 +153,46 @@ class DB:
     _Cls.metadata._remove_table(name, table.schema)
     self.metadata._add_table(name, table.schema, table)
     try:
-      self.metadata.create_all(self.engine, tables=[table])
-    except OperationalError:
-      ...
-    self.metadata._remove_table(name, table.schema)
-    self.tables[name] = _Cls
+      with tagged(phase='ddl'):
+        self.metadata.create_all(self.engine, tables=[table])
+        for index in table.indexes: # create_all skips the indexes of already existing tables
+          index.create(self.engine, checkfirst=True)
+    except OperationalError as e:
+      if not _already_exists(e): # another process created it between the check and the DDL
+        raise
+    finally:
+      self.metadata._remove_table(name, table.schema)
+    if key is not None:
+      self.tables[key] = _Cls
+
+    return _Cls # type: ignore
+
+
+def _already_exists(e: OperationalError) -> bool:
+  return 'already exists' in str(e.orig).lower()
+
+def _in_memory(db_url: str) -> bool:
+  url = make_url(db_url)
+  return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+def _cache_key(name: str, model: type[SQLModel]) -> Hashable | None:
+  key = name, tuple(
+    (field, info.annotation, _type_name(getattr(info, 'sa_type', None)))
+    for field, info in model.model_fields.items()
+  )
+  try:
+    hash(key)
+    return key
+  except TypeError:
+    return None
+def _type_name(sa_type) -> str:
+  """Name of a column type (class or instance). Column type classes are often created on the fly (e.g. `ValidatedJSON(T)`), so they're compared by name"""
+  return getattr(sa_type, '__name__', type(sa_type).__name__)
 
-    return _Cls # type: ignore
\ No newline at end of file
+def _set_pragmas(pragmas: Mapping[str, Any]):
+  def set_pragmas(conn, _):
+    cursor = conn.cursor()
+    for name, value in pragmas.items():
+      cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+  return set_pragmas
@@ -0,0 +1,184 @@
+from typing_extensions import Protocol, Sequence, Mapping, Iterator
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+import asyncio
+import bisect
+import threading
+import time
+from dslog import Logger
+
+METRICS: Mapping[str, str] = {
+  'pipeteer_queue_depth': 'Items in a queue (sampled)',
+  'pipeteer_claims_total': 'Items claimed from a queue',
+  'pipeteer_claim_seconds': 'Duration of a claim round trip',
+  'pipeteer_lease_expirations_total': 'Items claimed again because their lease ran out',
+  'pipeteer_call_seconds': "Duration of a pipeline's function (for workflows, of each replay)",
+  'pipeteer_commit_seconds': 'Duration of writing an output (or workflow state) and committing',
+  'pipeteer_errors_total': 'Errors, by stage',
+  'pipeteer_replays_total': 'Workflow replays',
+  'pipeteer_replayed_steps_total': 'Steps replayed by workflows',
+  'pipeteer_notifications_sent_total': 'Notifications sent, by topic',
+  'pipeteer_notifications_received_total': 'Notifications received, by topic',
+}
+"""Metrics reported by the pipelines, with their descriptions"""
+
+BUCKETS: Sequence[float] = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics(Protocol):
+  """Sink of the pipelines' metrics (`Context.metrics`). Names and labels follow Prometheus' conventions (see `METRICS`)"""
+  enabled: bool
+  """Whether metrics that cost extra work (like sampling queue depths) should be reported at all"""
+  def inc(self, name: str, value: float = 1, /, **labels: str):
+    """Increase counter `name`"""
+    ...
+  def set(self, name: str, value: float, /, **labels: str):
+    """Set gauge `name`"""
+    ...
+  def observe(self, name: str, value: float, /, **labels: str):
+    """Record `value` in histogram `name`"""
+    ...
+
+class NoMetrics(Metrics):
+  """Discards all metrics (the default)"""
+  enabled = False
+  def inc(self, name: str, value: float = 1, /, **labels: str):
+    ...
+  def set(self, name: str, value: float, /, **labels: str):
+    ...
+  def observe(self, name: str, value: float, /, **labels: str):
+    ...
+
+@contextmanager
+def timed(metrics: Metrics, name: str, /, **labels: str) -> Iterator[None]:
+  """Observe the duration of the block in histogram `name`"""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    metrics.observe(name, time.perf_counter() - start, **labels)
+
+@dataclass
+class Every:
+  """`every()` is true at most once every `interval` seconds"""
+  interval: float
+  _last: float = field(default=float('-inf'), init=False, repr=False)
+
+  def __call__(self) -> bool:
+    if (now := time.monotonic()) - self._last >= self.interval:
+      self._last = now
+      return True
+    return False
+
+
+Labels = tuple[tuple[str, str], ...]
+
+@dataclass
+class Histogram:
+  counts: list[int]
+  sum: float = 0
+  count: int = 0
+
+@dataclass
+class Registry(Metrics):
+  """In-memory metrics of this process, exposed in Prometheus' text format (`expose()`, or over HTTP with `serve()`)
+  - `buckets`: upper bounds (in seconds) of the histograms' buckets
+  """
+  buckets: Sequence[float] = BUCKETS
+  enabled = True
+  _counters: dict[str, dict[Labels, float]] = field(default_factory=dict, init=False, repr=False)
+  _gauges: dict[str, dict[Labels, float]] = field(default_factory=dict, init=False, repr=False)
+  _histograms: dict[str, dict[Labels, Histogram]] = field(default_factory=dict, init=False, repr=False)
+  _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+  def inc(self, name: str, value: float = 1, /, **labels: str):
+    key = tuple(sorted(labels.items()))
+    with self._lock:
+      series = self._counters.setdefault(name, {})
+      series[key] = series.get(key, 0) + value
+
+  def set(self, name: str, value: float, /, **labels: str):
+    key = tuple(sorted(labels.items()))
+    with self._lock:
+      self._gauges.setdefault(name, {})[key] = value
+
+  def observe(self, name: str, value: float, /, **labels: str):
+    key = tuple(sorted(labels.items()))
+    with self._lock:
+      series = self._histograms.setdefault(name, {})
+      if (hist := series.get(key)) is None:
+        hist = series[key] = Histogram([0] * len(self.buckets))
+      if (i := bisect.bisect_left(self.buckets, value)) < len(self.buckets):
+        hist.counts[i] += 1
+      hist.sum += value
+      hist.count += 1
+
+  def value(self, name: str, /, **labels: str) -> float | None:
+    """Current value of counter or gauge `name`"""
+    key = tuple(sorted(labels.items()))
+    with self._lock:
+      series = self._counters.get(name) or self._gauges.get(name) or {}
+      return series.get(key)
+
+  def expose(self) -> str:
+    """All metrics, in Prometheus' text exposition format"""
+    lines = []
+    def header(name: str, type: str):
+      if (desc := METRICS.get(name)) is not None:
+        lines.append(f'# HELP {name} {desc}')
+      lines.append(f'# TYPE {name} {type}')
+
+    with self._lock:
+      for type, metrics in [('counter', self._counters), ('gauge', self._gauges)]:
+        for name, series in sorted(metrics.items()):
+          header(name, type)
+          lines.extend(f'{name}{_labels(labels)} {value:g}' for labels, value in sorted(series.items()))
+
+      for name, hists in sorted(self._histograms.items()):
+        header(name, 'histogram')
+        for labels, hist in sorted(hists.items()):
+          total = 0
+          for le, n in zip(self.buckets, hist.counts):
+            total += n
+            lines.append(f'{name}_bucket{_labels(labels, le=f"{le:g}")} {total}')
+          lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {hist.count}')
+          lines.append(f'{name}_sum{_labels(labels)} {hist.sum:g}')
+          lines.append(f'{name}_count{_labels(labels)} {hist.count}')
+
+    return '\n'.join(lines) + '\n'
+
+  async def serve(self, host: str = '0.0.0.0', port: int = 9464, *, log: Logger = Logger.empty()):
+    """Serve `expose()` at `http://{host}:{port}/metrics`, for Prometheus to scrape"""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+      try:
+        request = await reader.readline()
+        while (await reader.readline()).strip(): # headers
+          ...
+        method, path, *_ = request.decode(errors='replace').split() + ['', '']
+        if method == 'GET' and path.split('?')[0] in ('/metrics', '/'):
+          status, body = '200 OK', self.expose().encode()
+        else:
+          status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+          f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+          f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+      except Exception as e:
+        log(f'Error serving metrics: {e}', level='WARNING')
+      finally:
+        writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    log(f'Serving metrics at http://{host}:{port}/metrics', level='INFO')
+    async with server:
+      await server.serve_forever()
+
+
+def _escape(value: str) -> str:
+  return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _labels(labels: Labels, **extra: str) -> str:
+  pairs = [*labels, *extra.items()]
+  if not pairs:
+    return ''
+  return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
@@ -0,0 +1,150 @@
+from typing_extensions import Sequence, Protocol, Literal
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field, KW_ONLY
+from dslog import Logger
+import asyncio
+import os
+
+Transport = Literal['tcp', 'inproc', 'local']
+
+class Subscriber(Protocol):
+  async def wait(self) -> list[str]:
+    """Wait for a notification. Returns the keys it hints (possibly none)"""
+    ...
+
+class Publisher(Protocol):
+  async def send(self, topic: str, keys: Sequence[str] = ()):
+    """Notify `topic`, optionally hinting the `keys` just written to it"""
+    ...
+  async def flush(self):
+    """Send the pending coalesced notifications"""
+    ...
+
+class Notifier(Protocol):
+  """How pipelines wake each other up (`Context.zmq`)"""
+  @property
+  def pub(self) -> Publisher:
+    ...
+  def sub(self, topic: str) -> Subscriber:
+    ...
+  async def flush(self):
+    ...
+  async def ready(self) -> bool:
+    """Wait until the topics subscribed so far get notifications. `False` if it gave up waiting"""
+    ...
+  async def proxy(self, log: Logger = Logger.empty()):
+    """Run the proxy the notifications go through, if any"""
+    ...
+
+
+@dataclass
+class CoalescingPub(ABC):
+  """
+  - `coalesce`: window (in seconds) in which sends of the same topic are merged into a single message, with the union of their keys.
+    `0` merges the sends of a single event loop tick; `None` (default) sends each right away.
+    Pending messages are sent when the window ends, on `flush()`, or when the event loop cancels the flush on shutdown.
+  - `max_keys`: max keys hinted by a coalesced message (subscribers scan for the rest)
+  """
+  _: KW_ONLY
+  coalesce: float | None = None
+  max_keys: int = 1024
+  _pending: dict[str, dict[str, None]] = field(default_factory=dict, init=False, repr=False)
+  _flusher: asyncio.Task | None = field(default=None, init=False, repr=False)
+
+  @abstractmethod
+  async def _send(self, topic: str, keys: Sequence[str]):
+    ...
+
+  async def send(self, topic: str, keys: Sequence[str] = ()):
+    """Notify `topic`, optionally hinting the `keys` just written to it"""
+    if self.coalesce is None:
+      await self._send(topic, keys)
+      return
+
+    pending = self._pending.setdefault(topic, {})
+    for key in keys:
+      if len(pending) >= self.max_keys:
+        break
+      pending[key] = None
+    if self._flusher is None:
+      self._flusher = asyncio.create_task(self._flush_later())
+
+  async def flush(self):
+    """Send the pending coalesced notifications"""
+    pending, self._pending = self._pending, {}
+    for topic, keys in pending.items():
+      await self._send(topic, list(keys))
+
+  async def _flush_later(self):
+    try:
+      await asyncio.sleep(self.coalesce or 0)
+    finally: # also on cancellation, so shutting down doesn't lose notifications
+      self._flusher = None
+      await self.flush()
+
+
+@dataclass
+class LocalSub:
+  """Notifications of `topic` queued in memory. Like a ZMQ socket, drops them beyond `maxsize` if nobody's waiting"""
+  topic: str
+  maxsize: int = 1000
+
+  def __post_init__(self):
+    self.queue: asyncio.Queue[list[str]] = asyncio.Queue(self.maxsize)
+
+  async def wait(self) -> list[str]:
+    """Wait for a notification on `topic`. Returns the keys it carries (possibly none)"""
+    return await self.queue.get()
+
+  def put(self, keys: Sequence[str]):
+    try:
+      self.queue.put_nowait(list(keys))
+    except asyncio.QueueFull:
+      ...
+
+@dataclass
+class LocalPub(CoalescingPub):
+  subs: dict[str, LocalSub]
+
+  async def _send(self, topic: str, keys: Sequence[str]):
+    if (sub := self.subs.get(topic)) is not None:
+      sub.put(keys)
+
+@dataclass
+class Local:
+  """In-memory notifier: wake-ups without sockets nor proxy, for pipelines running in a single process"""
+  coalesce: float | None = None
+  _pid: int = field(default_factory=os.getpid, init=False, repr=False)
+  _subs: dict[str, LocalSub] = field(default_factory=dict, init=False, repr=False)
+  _pub: LocalPub | None = field(default=None, init=False, repr=False)
+
+  def _check_pid(self):
+    if self._pid != (pid := os.getpid()):
+      # a forked process doesn't share the parent's memory: start over
+      self._pid = pid
+      self._subs = {}
+      self._pub = None
+
+  def sub(self, topic: str) -> LocalSub:
+    self._check_pid()
+    if topic not in self._subs:
+      self._subs[topic] = LocalSub(topic)
+    return self._subs[topic]
+
+  @property
+  def pub(self) -> LocalPub:
+    self._check_pid()
+    if self._pub is None:
+      self._pub = LocalPub(self._subs, coalesce=self.coalesce)
+    return self._pub
+
+  async def flush(self):
+    if self._pub is not None and self._pid == os.getpid():
+      await self._pub.flush()
+
+  async def ready(self) -> bool:
+    """Subscriptions are immediate"""
+    return True
+
+  async def proxy(self, log: Logger = Logger.empty()):
+    """Nothing to proxy"""
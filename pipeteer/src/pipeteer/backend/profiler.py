@@ -0,0 +1,131 @@
+from typing_extensions import Literal, TextIO, Iterator
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+from contextvars import ContextVar
+import random
+import re
+import sys
+import threading
+import time
+from sqlalchemy import Engine, event
+
+GroupBy = Literal['statement', 'phase', 'pipeline']
+Tags = tuple[str | None, str | None] # pipeline, phase
+
+_tags: ContextVar[Tags] = ContextVar('pipeteer_profile_tags', default=(None, None))
+
+@contextmanager
+def tagged(*, pipeline: str | None = None, phase: str | None = None) -> Iterator[None]:
+  """Attribute the queries run within the block to `pipeline` and `phase` (unset ones are inherited from enclosing blocks).
+  Tags follow the context: tasks created and `DB.run` calls made within the block carry them too
+  """
+  outer_pipeline, outer_phase = _tags.get()
+  token = _tags.set((pipeline or outer_pipeline, phase or outer_phase))
+  try:
+    yield
+  finally:
+    _tags.reset(token)
+
+_PARAMS = re.compile(r'\(\s*(?:\?|%\(\w+\)s|\$\d+)(?:\s*,\s*(?:\?|%\(\w+\)s|\$\d+))+\s*\)')
+
+def normalize(statement: str) -> str:
+  """Collapse whitespace and lists of parameters (e.g. `IN (?, ?, ?)`), so that equal statements are grouped"""
+  return _PARAMS.sub('(...)', ' '.join(statement.split()))
+
+@dataclass
+class Stat:
+  count: int = 0
+  total: float = 0
+  rows: int = 0
+  samples: list[float] = field(default_factory=list)
+  """Durations, sampled uniformly (reservoir) up to `Profiler.max_samples`"""
+
+  def add(self, elapsed: float, rows: int, max_samples: int):
+    self.count += 1
+    self.total += elapsed
+    self.rows += rows
+    if len(self.samples) < max_samples:
+      self.samples.append(elapsed)
+    elif (i := random.randrange(self.count)) < max_samples:
+      self.samples[i] = elapsed
+
+  def merge(self, other: 'Stat') -> 'Stat':
+    return Stat(self.count + other.count, self.total + other.total, self.rows + other.rows, self.samples + other.samples)
+
+  def percentile(self, p: float) -> float:
+    xs = sorted(self.samples)
+    return xs[min(len(xs)-1, int(p/100 * len(xs)))] if xs else 0
+
+@dataclass
+class Profiler:
+  """Time spent by each SQL statement of an engine, tagged by pipeline and phase (see `tagged`). Start it with `DB.profile()`
+  - `max_samples`: durations kept per statement, for percentiles
+  - Rows are those reported by the driver (written rows, for DML statements)
+  """
+  max_samples: int = 10_000
+  stats: dict[tuple[str | None, str | None, str], Stat] = field(default_factory=dict)
+  _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+  _engines: list[Engine] = field(default_factory=list, init=False, repr=False)
+
+  def attach(self, engine: Engine):
+    event.listen(engine, 'before_cursor_execute', self._before)
+    event.listen(engine, 'after_cursor_execute', self._after)
+    self._engines.append(engine)
+
+  def detach(self):
+    for engine in self._engines:
+      event.remove(engine, 'before_cursor_execute', self._before)
+      event.remove(engine, 'after_cursor_execute', self._after)
+    self._engines = []
+
+  def reset(self):
+    with self._lock:
+      self.stats = {}
+
+  def _before(self, conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('pipeteer_profile', []).append(time.perf_counter())
+
+  def _after(self, conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('pipeteer_profile')
+    if not starts:
+      return
+    elapsed = time.perf_counter() - starts.pop()
+    pipeline, phase = _tags.get()
+    rows = max(cursor.rowcount, 0)
+    key = pipeline, phase, normalize(statement)
+    with self._lock:
+      if (stat := self.stats.get(key)) is None:
+        stat = self.stats[key] = Stat()
+      stat.add(elapsed, rows, self.max_samples)
+
+  def grouped(self, by: GroupBy = 'statement') -> list[tuple[tuple[str | None, ...], Stat]]:
+    """Stats per statement (tagged by pipeline and phase), or merged per phase or pipeline, sorted by total time"""
+    with self._lock:
+      items = list(self.stats.items())
+    if by == 'statement':
+      return sorted(items, key=lambda it: it[1].total, reverse=True)
+    groups: dict[tuple[str | None, ...], Stat] = {}
+    for (pipeline, phase, _), stat in items:
+      key = (phase,) if by == 'phase' else (pipeline,)
+      groups[key] = groups[key].merge(stat) if key in groups else stat.merge(Stat())
+    return sorted(groups.items(), key=lambda it: it[1].total, reverse=True)
+
+  def report(self, by: GroupBy = 'statement', *, top: int | None = 20, width: int = 100) -> str:
+    """Table of the `top` entries by total time, grouped `by` statement, phase or pipeline"""
+    groups = self.grouped(by)
+    total = sum(stat.total for _, stat in groups) or 1
+    header = f'{"total (s)":>10} {"%":>5} {"count":>8} {"mean ms":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"rows":>8}  '
+    header += {'statement': 'pipeline / phase / statement', 'phase': 'phase', 'pipeline': 'pipeline'}[by]
+    lines = [header]
+    for key, stat in groups[:top]:
+      label = ' / '.join(k or '-' for k in key)
+      lines.append(
+        f'{stat.total:10.3f} {100*stat.total/total:5.1f} {stat.count:8d} {1e3*stat.total/stat.count:8.2f} '
+        f'{1e3*stat.percentile(50):8.2f} {1e3*stat.percentile(95):8.2f} {1e3*stat.percentile(99):8.2f} {stat.rows:8d}  '
+        + label[:width]
+      )
+    return '\n'.join(lines)
+
+  def dump(self, file: TextIO | None = None, by: GroupBy = 'statement', *, top: int | None = 20):
+    """Print the report (see `report`) to `file` (default: stderr)"""
+    print(self.report(by, top=top), file=file or sys.stderr)
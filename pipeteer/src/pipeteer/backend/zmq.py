@@ -1,48 +1,156 @@
+from typing_extensions import Sequence, Literal
 from dataclasses import dataclass, field
+from uuid import uuid4
+from collections import Counter
+import asyncio
 import os
 import zmq
 from zmq.asyncio import Context
 from dslog import Logger
+from .notifier import CoalescingPub, LocalSub
+
+ProxyMode = Literal['native', 'python']
 
 @dataclass
 class ZMQ:
+  """ZMQ notifier. All topics subscribed in a process share a single SUB socket (see `Dispatcher`)"""
   pub_url: str = 'tcp://localhost:5555'
   sub_url: str = 'tcp://localhost:5556'
-  _pid: int = os.getpid()
-  _subs: dict[str, 'Sub'] = field(default_factory=dict)
-  _pub: 'Pub | None' = None
+  coalesce: float | None = None
+  _pid: int = field(default_factory=os.getpid, init=False, repr=False)
+  _dispatcher: 'Dispatcher | None' = field(default=None, init=False, repr=False)
+  _pub: 'Pub | None' = field(default=None, init=False, repr=False)
 
   def __post_init__(self):
-    self._pub = Pub(self.pub_url)
+    self._pub = Pub(self.pub_url, coalesce=self.coalesce)
 
-  def sub(self, topic: str):
-    pid = os.getpid()
-    if self._pid != pid:
+  def _check_pid(self):
+    if self._pid != (pid := os.getpid()):
+      # sockets aren't fork-safe: start over
       self._pid = pid
-      self._subs = {}
+      self._dispatcher = None
+      self._pub = None
 
-    if not topic in self._subs:
-      self._subs[topic] = Sub(topic, self.sub_url)
+  @property
+  def dispatcher(self) -> 'Dispatcher':
+    self._check_pid()
+    if self._dispatcher is None:
+      self._dispatcher = Dispatcher(self.sub_url)
+    return self._dispatcher
 
-    return self._subs[topic]
+  def sub(self, topic: str) -> 'DispatchedSub':
+    return self.dispatcher.sub(topic)
 
   @property  
   def pub(self):
-    pid = os.getpid()
-    if self._pid != pid:
-      self._pid = pid
-      self._pub = None
-
+    self._check_pid()
     if self._pub is None:
-      self._pub = Pub(self.pub_url)
-
+      self._pub = Pub(self.pub_url, coalesce=self.coalesce)
     return self._pub
   
-  async def proxy(self, log: Logger = Logger.empty()):
-    await proxy(pub_url=self.pub_url, sub_url=self.sub_url, log=log)
+  async def flush(self):
+    """Send the pending coalesced notifications, if any"""
+    if self._pub is not None and self._pid == os.getpid():
+      await self._pub.flush()
+
+  async def ready(self, timeout: float = 2) -> bool:
+    """Wait until the topics subscribed so far get notifications (see `Dispatcher.ready`). `False` if that takes over `timeout` seconds"""
+    return await self.dispatcher.ready(self.pub, timeout=timeout)
+  
+  @classmethod
+  def inproc(cls, *, coalesce: float | None = None) -> 'ZMQ':
+    """Sockets connected within the process (`inproc://`), with no proxy in between"""
+    url = f'inproc://pipeteer-{uuid4().hex}'
+    return cls(pub_url=url, sub_url=url, coalesce=coalesce)
+
+  async def proxy(self, log: Logger = Logger.empty(), *, mode: ProxyMode = 'native'):
+    if self.pub_url.startswith('inproc://'):
+      return # subscribers connect to the publisher directly
+    if mode == 'native':
+      await native_proxy(pub_url=self.pub_url, sub_url=self.sub_url, log=log)
+    else:
+      await proxy(pub_url=self.pub_url, sub_url=self.sub_url, log=log)
+
+@dataclass
+class DispatchedSub(LocalSub):
+  """Notifications of `topic`, routed by a `Dispatcher`"""
+  dispatcher: 'Dispatcher | None' = None
+
+  async def wait(self) -> list[str]:
+    """Wait for a notification on `topic`. Returns the keys it carries (possibly none)"""
+    if self.dispatcher is not None:
+      self.dispatcher.start()
+    return await super().wait()
+
+@dataclass
+class Dispatcher:
+  """A single SUB socket for all the topics of a process, routing each message to its topic's in-memory queue.
+  Compared to a socket per topic: fewer file descriptors and connections to the proxy, and each message is received (and decoded) once.
+  Like a socket's, queues drop notifications beyond their `maxsize` if nobody's waiting
+  """
+  url: str = 'tcp://localhost:5556'
+  _subs: dict[bytes, DispatchedSub] = field(default_factory=dict, init=False, repr=False)
+  _task: asyncio.Task | None = field(default=None, init=False, repr=False)
+  _subscribed: int = field(default=0, init=False, repr=False)
+  _confirmed: int = field(default=0, init=False, repr=False)
+  _given_up: int = field(default=0, init=False, repr=False)
+  _sentinel: str = field(default_factory=lambda: f'pipeteer-ready-{uuid4().hex}', init=False, repr=False)
+
+  def __post_init__(self):
+    self.pid = os.getpid()
+    self.socket = Context.instance().socket(zmq.SUB)
+    self.socket.connect(self.url)
+    self.lock = asyncio.Lock()
+
+  def sub(self, topic: str) -> DispatchedSub:
+    if os.getpid() != self.pid:
+      raise RuntimeError('Dispatcher is not fork-safe')
+    key = topic.encode()
+    if (sub := self._subs.get(key)) is None:
+      sub = self._subs[key] = DispatchedSub(topic, dispatcher=self)
+      self.socket.setsockopt(zmq.SUBSCRIBE, key)
+      self._subscribed += 1
+    return sub
+
+  def start(self):
+    """Start routing messages (in a task of the running event loop), if not already"""
+    if self._task is None or self._task.done():
+      self._task = asyncio.create_task(self._dispatch())
+
+  async def _dispatch(self):
+    while True:
+      topic, *keys = await self.socket.recv_multipart()
+      if (sub := self._subs.get(topic)) is not None: # subscriptions match prefixes, too
+        sub.put([key.decode() for key in keys])
+
+  async def ready(self, pub: 'Pub', *, timeout: float = 2, interval: float = 0.05) -> bool:
+    """Wait until the topics subscribed so far get notifications, by sending sentinels through `pub` until one comes back.
+    ZMQ subscriptions reach publishers asynchronously (through the proxy), so notifications sent right after subscribing could otherwise be lost.
+    Returns `False` if none came back within `timeout` seconds (e.g. the proxy isn't running)
+    """
+    target = self._subscribed
+    async with self.lock:
+      if self._confirmed >= target or self._given_up >= target:
+        return self._confirmed >= target
+      sentinel = self.sub(self._sentinel) # subscribed after `target`'s topics, so confirms them too
+      self.start()
+      deadline = asyncio.get_running_loop().time() + timeout
+      while self._confirmed < target:
+        if asyncio.get_running_loop().time() >= deadline:
+          self._given_up = self._subscribed # don't make later callers wait again
+          return False
+        await pub.send(self._sentinel, [str(self._subscribed)]) # confirms every topic subscribed by now
+        await pub.flush()
+        try:
+          keys = await asyncio.wait_for(sentinel.wait(), interval)
+          self._confirmed = max([self._confirmed, *map(int, keys)])
+        except asyncio.TimeoutError:
+          ...
+      return True
 
 @dataclass
 class Sub:
+  """A SUB socket of its own, for `topic` (pipelines share a `Dispatcher`'s instead)"""
   topic: str
   url: str = 'tcp://localhost:5556'
 
@@ -53,28 +161,39 @@ class Sub:
     self.sub.connect(self.url)
     self.sub.setsockopt_string(zmq.SUBSCRIBE, self.topic)
 
-  async def wait(self):
+  async def wait(self) -> list[str]:
+    """Wait for a notification on `topic`. Returns the keys it carries (possibly none)"""
     if os.getpid() != self.pid:
       raise RuntimeError('Sub is not fork-safe')
     while True:
-      topic = await self.sub.recv_string()
-      if topic == self.topic: # could be a prefix but not equal
-        return
+      topic, *keys = await self.sub.recv_multipart()
+      if topic.decode() == self.topic: # could be a prefix but not equal
+        return [key.decode() for key in keys]
 
 @dataclass
-class Pub:
+class Pub(CoalescingPub):
+  """Publishes (as multipart messages: the topic, then the hinted keys) to a proxy at `url`.
+  An `inproc://` URL is bound instead, so that subscribers of the same process connect directly, without proxy
+  """
   url: str = 'tcp://localhost:5555'
 
   def __post_init__(self):
     self.pid = os.getpid()
     ctx = Context.instance()
     self.pub = ctx.socket(zmq.PUB)
-    self.pub.connect(self.url)
+    if self.url.startswith('inproc://'):
+      self.pub.bind(self.url)
+    else:
+      self.pub.connect(self.url)
 
-  async def send(self, topic: str):
+  async def send(self, topic: str, keys: Sequence[str] = ()):
+    """Notify `topic`, optionally hinting the `keys` just written to it (as extra frames of a multipart message)"""
     if os.getpid() != self.pid:
       raise RuntimeError('Pub is not fork-safe')
-    await self.pub.send_string(topic)
+    await super().send(topic, keys)
+
+  async def _send(self, topic: str, keys: Sequence[str]):
+    await self.pub.send_multipart([topic.encode(), *(key.encode() for key in keys)])
 
 
 async def proxy(
@@ -92,8 +211,78 @@ async def proxy(
   backend.bind(sub_url)
 
   while True:
-    msg = await frontend.recv()
+    msg = await frontend.recv_multipart()
     log('Proxying:', msg, level='DEBUG')
-    await backend.send(msg)
+    await backend.send_multipart(msg)
+
+
+
+
+async def native_proxy(
+  pub_url: str = 'tcp://*:5555', sub_url: str = 'tcp://*:5556', *,
+  capture_url: str | None = None,
+  stats_interval: float | None = None,
+  log: Logger = Logger.empty(),
+):
+  """Proxy running on libzmq's steerable proxy (XSUB -> XPUB) in a background thread, so forwarding never enters Python
+  - `capture_url`: if given, every message going through the proxy (including subscriptions) is also published there
+  - `stats_interval`: if given, log the messages/s of each topic every `stats_interval` seconds (read from the capture socket)
+  """
+  ctx = zmq.Context()
+  frontend = ctx.socket(zmq.XSUB)
+  frontend.bind(pub_url)
+  backend = ctx.socket(zmq.XPUB)
+  backend.bind(sub_url)
+
+  control = ctx.socket(zmq.PAIR)
+  control.bind('inproc://control')
+  steer = ctx.socket(zmq.PAIR)
+  steer.connect('inproc://control')
+
+  capture = None
+  if capture_url is not None or stats_interval is not None:
+    capture = ctx.socket(zmq.PUB)
+    capture.bind('inproc://capture')
+    if capture_url is not None:
+      capture.bind(capture_url)
+
+  print(f'Proxying {pub_url} -> {sub_url} [NATIVE]')
+  stats = None
+  if stats_interval is not None:
+    stats = asyncio.create_task(proxy_stats(Context(ctx), 'inproc://capture', stats_interval, log))
 
+  done = asyncio.get_running_loop().run_in_executor(None, zmq.proxy_steerable, frontend, backend, capture, control)
+  try:
+    await asyncio.shield(done)
+  finally:
+    steer.send(b'TERMINATE')
+    await done
+    if stats is not None:
+      stats.cancel()
+    ctx.destroy(linger=0)
 
+
+async def proxy_stats(ctx: Context, capture_url: str, interval: float, log: Logger):
+  """Log the messages/s of each topic published to `capture_url`, every `interval` seconds"""
+  sub = ctx.socket(zmq.SUB)
+  sub.connect(capture_url)
+  sub.setsockopt(zmq.SUBSCRIBE, b'')
+  counts = Counter[str]()
+
+  async def read():
+    while True:
+      topic, *keys = await sub.recv_multipart()
+      if not keys and topic[:1] in (b'\x00', b'\x01'): # (un)subscription going upstream
+        continue
+      counts[topic.decode(errors='replace')] += 1
+
+  reader = asyncio.create_task(read())
+  try:
+    while True:
+      await asyncio.sleep(interval)
+      window, counts = counts, Counter[str]()
+      rates = ', '.join(f'{topic}: {n/interval:.1f}' for topic, n in window.most_common())
+      log(f'Messages/s: {rates or "-"}', level='INFO')
+  finally:
+    reader.cancel()
+    sub.close(linger=0)
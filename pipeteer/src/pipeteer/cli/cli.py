@@ -10,10 +10,20 @@ def callback():
 def proxy(
   pub_url: str = typer.Option('tcp://*:5555', '-p', '--pub'),
   sub_url: str = typer.Option('tcp://*:5556', '-s', '--sub'),
-  verbose: bool = typer.Option(False, '-v', '--verbose')
+  verbose: bool = typer.Option(False, '-v', '--verbose', help='Log every message (python mode). Implied by --stats'),
+  mode: str = typer.Option('native', '-m', '--mode', help="'native' (libzmq's proxy, forwarding never enters Python) or 'python'"),
+  capture_url: str = typer.Option(None, '-c', '--capture', help='Also publish every message here (native mode)'),
+  stats: float = typer.Option(None, '--stats', help='Log messages/s per topic every STATS seconds (native mode)'),
 ):
   import asyncio
   from dslog import Logger
-  from pipeteer.backend import proxy
-  log = Logger.click().prefix('[PROXY]') if verbose else Logger.empty()
-  asyncio.run(proxy(pub_url=pub_url, sub_url=sub_url, log=log))
+  from pipeteer.backend import proxy, native_proxy
+  log = Logger.click().prefix('[PROXY]') if verbose or stats is not None else Logger.empty()
+  if mode == 'native':
+    asyncio.run(native_proxy(pub_url=pub_url, sub_url=sub_url, capture_url=capture_url, stats_interval=stats, log=log))
+  elif mode == 'python':
+    if capture_url is not None or stats is not None:
+      raise typer.BadParameter('--capture and --stats require --mode native')
+    asyncio.run(proxy(pub_url=pub_url, sub_url=sub_url, log=log))
+  else:
+    raise typer.BadParameter(f"Unknown mode: '{mode}'. Expected 'native' or 'python'")
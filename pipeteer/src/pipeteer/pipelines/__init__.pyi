@@ -3,6 +3,9 @@ from ._activity import activity, Activity
 from ._workflow import workflow, Workflow, WorkflowContext
 from ._task import task, Task, Push
 from ._multitask import multitask, MultiTask
+from ._tracing import Span, timeline, latencies, hops
+from ._scheduler import Scheduler
+from ._runtime import run
 
 __all__ = [
   'Pipeline', 'Inputtable', 'Runnable', 'Context', 'Input', 'Entry', 'InputT', 'EntryT',
@@ -10,4 +13,6 @@ __all__ = [
   'workflow', 'Workflow', 'WorkflowContext',
   'task', 'Task', 'Push',
   'multitask', 'MultiTask',
+  'Span', 'timeline', 'latencies', 'hops',
+  'Scheduler', 'run',
 ]
\ No newline at end of file
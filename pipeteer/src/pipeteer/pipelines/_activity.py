@@ -1,62 +1,178 @@
-from typing_extensions import TypeVar, Generic, Callable, Awaitable, Coroutine
-from dataclasses import dataclass
+from typing_extensions import TypeVar, Generic, Callable, Awaitable, Coroutine, Literal, Any
+from dataclasses import dataclass, field
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import cache
 import asyncio
+import os
+import inspect
+import importlib
+import multiprocessing
 from datetime import timedelta, datetime
-from multiprocessing import Process
 import traceback
-from sqlmodel import select, Session, or_
+from sqlmodel import Session
 from pipeteer.pipelines import Pipeline, Context, Entry
-from pipeteer.util import param_type, return_type, num_params, Func1or2, race
+from pipeteer.backend.metrics import timed, Every
+from pipeteer.backend.profiler import tagged
+from pipeteer.util import param_type, return_type, num_params, Func1or2
+from ._claim import Hints, DEPTH_INTERVAL, queue_depth
+from ._tracing import record
+from ._scheduler import Scheduler, Poller
 
 A = TypeVar('A')
 B = TypeVar('B')
 Ctx = TypeVar('Ctx', bound=Context)
+ExecutorKind = Literal['thread', 'process']
+
+def _call_sync(fn: Callable, *args):
+  y = fn(*args)
+  return asyncio.run(y) if inspect.isawaitable(y) else y # type: ignore
+
+@cache
+def _resolve(module: str, qualname: str) -> Callable:
+  obj: Any = importlib.import_module(module)
+  for attr in qualname.split('.'):
+    obj = getattr(obj, attr)
+  # the decorated function's name is bound to the `Activity` itself
+  return obj.call.fn if isinstance(obj, Activity) else obj
+
+def _call_ref(module: str, qualname: str, x):
+  return _call_sync(_resolve(module, qualname), x)
+
+@dataclass
+class PoolCall(Generic[A, B, Ctx]):
+  """Runs `fn` (sync or async) on a thread or process pool, created lazily in each worker process
+  - Process pools look `fn` up by module and qualified name, so it must be defined at module level
+  - Process pools spawn their processes: the worker already runs background threads (e.g. ZMQ's), whose locks a fork could copy while held
+  """
+  fn: Callable[[A, Ctx], B | Awaitable[B]] | Callable[[A], B | Awaitable[B]]
+  executor: ExecutorKind
+  workers: int
+  _pool: Executor | None = field(default=None, init=False, repr=False)
+  _pid: int | None = field(default=None, init=False, repr=False)
+
+  def pool(self) -> Executor:
+    if self._pool is None or self._pid != os.getpid():
+      if self.executor == 'thread':
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+      else:
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+      self._pid = os.getpid()
+    return self._pool
+  
+  def shutdown(self):
+    if self._pool is not None and self._pid == os.getpid():
+      self._pool.shutdown(wait=False, cancel_futures=True)
+    self._pool = None
+
+  async def __call__(self, x: A, ctx: Ctx) -> B:
+    loop = asyncio.get_running_loop()
+    if self.executor == 'process':
+      return await loop.run_in_executor(self.pool(), _call_ref, self.fn.__module__, self.fn.__qualname__, x)
+    args = (x, ctx) if num_params(self.fn) == 2 else (x,)
+    return await loop.run_in_executor(self.pool(), _call_sync, self.fn, *args)
 
 @dataclass
 class Activity(Pipeline[A, B, Ctx, Coroutine], Generic[A, B, Ctx]):
   call: Callable[[A, Ctx], Awaitable[B]]
   reserve: timedelta | None = None
   poll_interval: timedelta = timedelta(seconds=1)
+  max_concurrency: int = 1
+  claim_batch: int = 1
 
   def run(self, ctx: Ctx) -> Coroutine:
+    metrics = ctx.metrics
+
+    async def process(inp, key: str, val, out: str, claimed_at: datetime):
+      ctx.log(f'Processing "{key}"', level='DEBUG')
+      try:
+        with timed(metrics, 'pipeteer_call_seconds', pipeline=self.id):
+          y = await self.call(val, ctx)
+
+        def write():
+          Output = ctx.db.table(out, Entry(self.Tout, ctx.db.codec))
+          with Session(ctx.db.engine) as s:
+            s.add(Output(key=key, value=y))
+            s.delete(inp)
+            if ctx.trace:
+              record(s, ctx.db, self.id, [key], claimed=claimed_at, finished=datetime.now())
+            s.commit()
+
+        with timed(metrics, 'pipeteer_commit_seconds', pipeline=self.id), tagged(phase='output'):
+          await ctx.db.write(write)
+        await ctx.notify(out, [key])
+
+      except Exception:
+        metrics.inc('pipeteer_errors_total', pipeline=self.id, stage='process')
+        ctx.log(f'Error processing "{key}": {traceback.format_exc()}. Value: {val}', level='ERROR')
+
     async def loop():
       ctx.log('Running...', level='DEBUG')
-      pub = ctx.zmq.pub
+      poller = Scheduler.current().register(ctx.db, self.input(ctx), max_interval=self.poll_interval.total_seconds())
+      try:
+        with tagged(pipeline=self.id):
+          await serve(poller)
+      finally:
+        poller.close()
+        if isinstance(self.call, PoolCall):
+          self.call.shutdown()
+        await ctx.zmq.flush()
+
+    async def serve(poller: Poller):
       sub = ctx.zmq.sub(self.id)
       Input = self.input(ctx)
+      slots = asyncio.Semaphore(self.max_concurrency)
+      running: dict[str, asyncio.Task] = {}
+      claimed: deque = deque() # (item, claim time)
+      hints = Hints()
+      sample = Every(DEPTH_INTERVAL)
+      labels = dict(pipeline=self.id, queue='input')
+      if not await ctx.zmq.ready(): # claim only once notifications get through, so none is lost in between
+        ctx.log('Subscription not confirmed (is the proxy running?). Relying on polls', level='WARNING')
+
+      def done(key: str):
+        running.pop(key, None)
+        slots.release()
+
       while True:
+        await slots.acquire()
+        held = True # until handed over to the item's task
         try:
-          with Session(ctx.db.engine) as s:
-            free = or_(Input.ttl == None, Input.ttl < datetime.now()) # type: ignore
-            if not (inp := s.exec(select(Input).where(free)).first()):
-              await race([
-                asyncio.sleep(self.poll_interval.total_seconds()),
-                sub.wait()
-              ])
-              continue
-            elif self.reserve:
-              inp.ttl = datetime.now() + self.reserve
-              s.commit()
-
-            key, val, out = inp.key, inp.value, inp.output
-          
-          ctx.log(f'Processing "{key}"', level='DEBUG')
-
-          try:
-            y = await self.call(val, ctx)
-            Output = ctx.db.table(out, Entry(self.Tout))
-
-            with Session(ctx.db.engine) as s:
-              s.add(Output(key=key, value=y))
-              s.delete(inp)
-              s.commit()
-
-            await pub.send(out)
-
-          except Exception:
-            ctx.log(f'Error processing "{key}": {traceback.format_exc()}. Value: {val}', level='ERROR')
+          if metrics.enabled and sample():
+            with tagged(phase='depth'):
+              metrics.set('pipeteer_queue_depth', await ctx.db.run(queue_depth, ctx.db.engine, Input), **labels)
+          if not claimed:
+            with timed(metrics, 'pipeteer_claim_seconds', **labels), tagged(phase='claim'):
+              rows = await ctx.db.write(lambda: hints.claim(
+                ctx.db.engine, Input, self.claim_batch, reserve=self.reserve,
+                where=[Input.key.not_in(list(running))] # type: ignore
+              ))
+            now = datetime.now()
+            claimed.extend((row, now) for row in rows)
+            if rows:
+              poller.reset()
+            metrics.inc('pipeteer_claims_total', len(rows), **labels)
+            if hints.expired:
+              metrics.inc('pipeteer_lease_expirations_total', hints.expired, **labels)
+              hints.expired = 0
+          if not claimed:
+            slots.release()
+            held = False
+            if (keys := await poller.wait(sub)) is not None:
+              metrics.inc('pipeteer_notifications_received_total', topic=self.id)
+              hints.add(keys)
+            continue
+
+          inp, claimed_at = claimed.popleft()
+          key, val, out = inp.key, inp.value, inp.output
+          running[key] = task = asyncio.create_task(process(inp, key, val, out, claimed_at))
+          held = False
+          task.add_done_callback(lambda _, key=key: done(key))
 
         except Exception:
+          if held:
+            slots.release()
+          metrics.inc('pipeteer_errors_total', pipeline=self.id, stage='claim')
           ctx.log(f'Error reading from input queue: {traceback.format_exc()}', level='ERROR')
       
     return loop()
@@ -64,9 +180,32 @@ class Activity(Pipeline[A, B, Ctx, Coroutine], Generic[A, B, Ctx]):
 def activity(
   id: str | None = None, *,
   reserve: timedelta | None = timedelta(minutes=2),
-  poll_interval: timedelta = timedelta(minutes=2)
+  poll_interval: timedelta = timedelta(seconds=10),
+  max_concurrency: int | None = None,
+  claim_batch: int = 1,
+  executor: ExecutorKind | None = None,
+  workers: int | None = None,
 ):
-  def decorator(fn: Func1or2[A, Ctx, Awaitable[B]]) -> Activity[A, B, Ctx]:
+  """
+  - `reserve`: how long a claimed item is leased before other workers may retry it
+  - `poll_interval`: max time between polls of the input queue, when idle. Polls back off up to it, and notifications wake the worker earlier (see `Scheduler`)
+  - `max_concurrency`: max number of items processed at once (as asyncio tasks) by a single worker. Defaults to `workers` (or 1)
+  - `claim_batch`: max number of items leased per round trip to the input queue
+  - `executor`: run the (sync or async) function on a `'thread'` or `'process'` pool of `workers` (default: CPU count).
+    Claiming and committing stay on the event loop. Process pools don't receive the context.
+  """
+  if workers is not None and workers < 1:
+    raise ValueError(f'workers must be at least 1, got {workers}')
+  if executor is not None and workers is None:
+    workers = os.cpu_count() or 1
+  if max_concurrency is None:
+    max_concurrency = workers if workers is not None else 1
+  if max_concurrency < 1:
+    raise ValueError(f'max_concurrency must be at least 1, got {max_concurrency}')
+  if claim_batch < 1:
+    raise ValueError(f'claim_batch must be at least 1, got {claim_batch}')
+  
+  def decorator(fn: Func1or2[A, Ctx, Awaitable[B] | B]) -> Activity[A, B, Ctx]:
     Tin = param_type(fn)
     if Tin is None:
       raise TypeError(f'Activity {fn.__name__} must have a type hint for its input parameter')
@@ -74,11 +213,22 @@ def activity(
     Tout = return_type(fn)
     if Tout is None:
       raise TypeError(f'Activity {fn.__name__} must have a type hint for its return value')
+    
+    if executor == 'process':
+      if num_params(fn) == 2:
+        raise TypeError(f'Activity {fn.__name__} cannot take a context when running on a process pool')
+      if '<locals>' in fn.__qualname__:
+        raise TypeError(f'Activity {fn.__name__} must be defined at module level to run on a process pool')
+    
+    if executor is not None:
+      call = PoolCall(fn, executor, workers) # type: ignore
+    else:
+      call = fn if num_params(fn) == 2 else (lambda x, _: fn(x))
 
     return Activity(
       Tin=Tin or param_type(fn), Tout=Tout or return_type(fn), reserve=reserve, id=id or fn.__name__,
-      call=fn if num_params(fn) == 2 else (lambda x, _: fn(x)), # type: ignore
-      poll_interval=poll_interval
+      call=call, # type: ignore
+      poll_interval=poll_interval, max_concurrency=max_concurrency, claim_batch=claim_batch,
     )
       
   return decorator
\ No newline at end of file
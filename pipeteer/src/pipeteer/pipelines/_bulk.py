@@ -0,0 +1,57 @@
+from typing_extensions import Literal, Iterable, Sequence, Mapping, Any, TypeVar
+from itertools import islice
+from sqlalchemy import insert, Insert
+from sqlmodel import SQLModel, Session
+
+T = TypeVar('T')
+OnConflict = Literal['error', 'ignore', 'replace']
+
+MAX_HINTS = 1024
+"""Max keys hinted by a bulk notification (beyond that, workers just scan the queue)"""
+
+def chunks(xs: Iterable[T], size: int) -> Iterable[list[T]]:
+  it = iter(xs)
+  while (chunk := list(islice(it, size))):
+    yield chunk
+
+def defaults(Table: type[SQLModel]) -> dict[str, Any]:
+  """Default values of `Table`'s optional fields (Core inserts don't fill them in, unlike the model's constructor)"""
+  return {
+    name: field.get_default(call_default_factory=True)
+    for name, field in Table.model_fields.items()
+    if not field.is_required()
+  }
+
+def insert_stmt(
+  s: Session, Table: type[SQLModel], on_conflict: OnConflict = 'error', *,
+  columns: Sequence[str] | None = None,
+) -> Insert:
+  """Insert into `Table` (keyed by `key`), resolving duplicate keys as per `on_conflict`
+  - `'error'`: raise (rolling back the whole transaction)
+  - `'ignore'`: keep the existing rows
+  - `'replace'`: overwrite the existing rows' `columns` (default: all but `key`)
+  """
+  if on_conflict == 'error':
+    return insert(Table)
+
+  dialect = s.get_bind().dialect.name
+  if dialect == 'sqlite':
+    from sqlalchemy.dialects.sqlite import insert as dialect_insert
+  elif dialect == 'postgresql':
+    from sqlalchemy.dialects.postgresql import insert as dialect_insert
+  else:
+    raise NotImplementedError(f'on_conflict="{on_conflict}" is not supported on {dialect}')
+
+  stmt = dialect_insert(Table)
+  if on_conflict == 'ignore':
+    return stmt.on_conflict_do_nothing(index_elements=['key'])
+  elif on_conflict == 'replace':
+    cols = columns or [c.name for c in Table.__table__.columns if c.name != 'key'] # type: ignore
+    return stmt.on_conflict_do_update(index_elements=['key'], set_={c: stmt.excluded[c] for c in cols})
+  raise ValueError(f'Unknown on_conflict: "{on_conflict}"')
+
+def hints(keys: Sequence[str]) -> Sequence[str]:
+  return keys if len(keys) <= MAX_HINTS else ()
+
+def items_of(items: Mapping[str, T] | Iterable[tuple[str, T]]) -> Iterable[tuple[str, T]]:
+  return items.items() if isinstance(items, Mapping) else items
@@ -0,0 +1,122 @@
+from typing_extensions import TypeVar, Sequence, Iterable
+from dataclasses import dataclass, field
+from itertools import islice
+from datetime import datetime, timedelta
+from sqlalchemy import Engine, ColumnElement, Index, update, column, func
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import SQLModel, Session, select, or_
+from pipeteer.backend.profiler import tagged
+
+T = TypeVar('T', bound=SQLModel)
+
+DEPTH_INTERVAL = 5
+"""Seconds between samples of a queue's depth (when metrics are enabled)"""
+
+def claim_indexes(table: str, *columns: str) -> tuple[Index, ...]:
+  """Index matching `claim`'s access path: equality on `columns`, then rows ordered by `ttl` (nulls first) and `key`.
+  Free rows (`ttl IS NULL OR ttl < now`) are thus a prefix of the index, and claims read just the rows they return.
+  """
+  name = f'ix_{table}_claim'
+  return (
+    Index(name, *columns, 'ttl', 'key').ddl_if(callable_=lambda *_, dialect, **__: dialect.name != 'postgresql'),
+    Index(name, *columns, column('ttl').asc().nulls_first(), 'key').ddl_if(dialect='postgresql'),
+  )
+
+def claim(
+  engine: Engine, Table: type[T], n: int = 1, *,
+  where: Sequence[ColumnElement[bool]] = (),
+  reserve: timedelta | None = None,
+) -> Sequence[T]:
+  """Claim up to `n` free rows of `Table` (leasing them for `reserve`, if given) in a single transaction
+  - `Table` must have `key` and `ttl` columns
+  - `where`: extra conditions the claimed rows must satisfy
+  - Returned rows are detached, with all their attributes loaded
+  - Rows are claimed in `(ttl, key)` order (free rows first, then expired leases), served by `claim_indexes`
+
+  Leases are atomic: concurrent workers never claim the same row (unless `reserve is None`, in which case nothing is leased).
+  On Postgres, rows locked by other workers are skipped (`FOR UPDATE SKIP LOCKED`).
+  Elsewhere, each candidate is leased with a conditional `UPDATE`, and only kept if it actually updated the row.
+  """
+  return claim_expired(engine, Table, n, where=where, reserve=reserve)[0]
+
+def claim_expired(
+  engine: Engine, Table: type[T], n: int = 1, *,
+  where: Sequence[ColumnElement[bool]] = (),
+  reserve: timedelta | None = None,
+) -> tuple[Sequence[T], int]:
+  """Like `claim`, also returning how many of the claimed rows had an expired lease"""
+  now = datetime.now()
+  free = or_(Table.ttl == None, Table.ttl < now) # type: ignore
+  postgres = engine.dialect.name == 'postgresql'
+  order = (Table.ttl.asc().nulls_first() if postgres else Table.ttl, Table.key) # type: ignore
+  with Session(engine, expire_on_commit=False) as s:
+    if reserve is None:
+      rows = s.exec(select(Table).where(free, *where).order_by(*order).limit(n)).all()
+      return rows, sum(row.ttl is not None for row in rows) # type: ignore
+
+    ttl = now + reserve
+    if postgres:
+      candidates = select(Table.key, Table.ttl).where(free, *where).order_by(*order).limit(n).with_for_update(skip_locked=True).cte() # type: ignore
+      stmt = update(Table).where(Table.key == candidates.c.key).values(ttl=ttl).returning(Table, candidates.c.ttl) # type: ignore
+      claimed = s.execute(stmt).all()
+      rows, expired = [row for row, _ in claimed], sum(prev is not None for _, prev in claimed)
+    else:
+      candidates = s.exec(select(Table).where(free, *where).order_by(*order).limit(n)).all()
+      rows, expired = [], 0
+      with tagged(phase='lease'):
+        for row in candidates:
+          stmt = update(Table).where(Table.key == row.key, free).values(ttl=ttl) # type: ignore
+          if s.exec(stmt.execution_options(synchronize_session=False)).rowcount == 1: # type: ignore[call-overload]
+            expired += row.ttl is not None # type: ignore
+            set_committed_value(row, 'ttl', ttl)
+            rows.append(row)
+    s.commit()
+    return rows, expired
+
+def queue_depth(engine: Engine, Table: type[SQLModel]) -> int:
+  """Number of rows in `Table` (leased or not)"""
+  with Session(engine) as s:
+    return s.exec(select(func.count()).select_from(Table)).one()
+
+def any_free(engine: Engine, queues: Sequence[tuple[type[SQLModel], Sequence[ColumnElement[bool]]]]) -> list[bool]:
+  """Whether each of `queues` (`(Table, where)`, as in `claim`) has free rows, probed in a single query (an `EXISTS` per queue, served by `claim_indexes`)"""
+  now = datetime.now()
+  checks = [
+    select(Table.key).where(or_(Table.ttl == None, Table.ttl < now), *where).exists() # type: ignore
+    for Table, where in queues
+  ]
+  with Session(engine) as s:
+    row = s.execute(select(*(check.label(f'q{i}') for i, check in enumerate(checks)))).one()
+  return [bool(free) for free in row]
+
+@dataclass
+class Hints:
+  """Keys announced by notifications. They're claimed by primary key first, falling back to a scan if missing or stale"""
+  max_size: int = 1024
+  keys: dict[str, None] = field(default_factory=dict) # insertion-ordered set
+  expired: int = 0
+  """Claimed rows whose lease had expired, since last reset"""
+
+  def add(self, keys: Iterable[str]):
+    for key in keys:
+      self.keys[key] = None
+    while len(self.keys) > self.max_size: # the scan will find the dropped ones anyway
+      del self.keys[next(iter(self.keys))]
+
+  def claim(
+    self, engine: Engine, Table: type[T], n: int = 1, *,
+    where: Sequence[ColumnElement[bool]] = (),
+    reserve: timedelta | None = None,
+  ) -> Sequence[T]:
+    """Like `claim`, but tries up to `n` hinted keys first"""
+    if self.keys:
+      keys = list(islice(self.keys, n))
+      for key in keys:
+        del self.keys[key]
+      rows, expired = claim_expired(engine, Table, n, where=[Table.key.in_(keys), *where], reserve=reserve) # type: ignore
+      if rows:
+        self.expired += expired
+        return rows
+    rows, expired = claim_expired(engine, Table, n, where=where, reserve=reserve)
+    self.expired += expired
+    return rows
@@ -0,0 +1,45 @@
+from typing_extensions import Any, Iterable
+import asyncio
+import inspect
+from pipeteer.pipelines import Runnable, Inputtable, Context
+from ._multitask import MultiTask
+
+def flatten(pipelines: Iterable[Runnable]) -> Iterable[Runnable]:
+  """`pipelines`, with multitasks replaced by the pipelines they compose"""
+  for pipe in pipelines:
+    if isinstance(pipe, MultiTask):
+      yield from flatten(pipe.pipelines)
+    else:
+      yield pipe
+
+async def run(ctx: Context, *pipelines: Runnable[Any, Any, Any, Any]):
+  """Run the worker loops of `pipelines` in this process, until one fails (or it's cancelled)
+  1. Creates the input tables of all pipelines upfront, so that none is created while others write
+  2. Starts the loops. Each subscribes to its topics, then waits for the subscriptions to get through (`Notifier.ready`) before claiming.
+    With ZMQ, all of the process' subscriptions share a single SUB socket (see `Dispatcher`)
+  3. On exit, cancels the remaining loops and sends pending notifications
+
+  Pipelines whose `run` doesn't return a loop (e.g. tasks, which are pushed to) are rejected
+  """
+  for pipe in flatten(pipelines):
+    if isinstance(pipe, Inputtable):
+      pipe.input(ctx)
+
+  loops = []
+  for pipe in pipelines:
+    loops.append(loop := pipe.run(ctx))
+    if not inspect.isawaitable(loop):
+      for other in loops:
+        if inspect.iscoroutine(other):
+          other.close()
+      raise TypeError(f'Pipeline "{pipe.id}" has no worker loop to run: its `run` returns {type(loop).__name__}')
+
+  tasks = [asyncio.ensure_future(loop) for loop in loops]
+  ctx.log(f'Running {len(tasks)} pipelines', level='DEBUG')
+  try:
+    await asyncio.gather(*tasks)
+  finally:
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await ctx.zmq.flush()
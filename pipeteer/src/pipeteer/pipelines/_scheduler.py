@@ -0,0 +1,146 @@
+from typing_extensions import Sequence, ClassVar
+from dataclasses import dataclass, field
+from weakref import WeakKeyDictionary
+import asyncio
+import random
+import time
+from sqlalchemy import ColumnElement, Engine
+from sqlmodel import SQLModel
+from pipeteer.backend import DB, Subscriber
+from pipeteer.backend.profiler import tagged
+from pipeteer.util import race
+from ._claim import any_free
+
+@dataclass(eq=False)
+class Poller:
+  """A queue registered with the `Scheduler`, waited on by a worker loop when it runs out of items"""
+  scheduler: 'Scheduler'
+  db: DB
+  Table: type[SQLModel]
+  where: Sequence[ColumnElement[bool]]
+  max_interval: float
+  interval: float = 0
+  due: float | None = None # next probe (monotonic), while waiting
+  _woken: asyncio.Event = field(default_factory=asyncio.Event, init=False, repr=False)
+
+  def __post_init__(self):
+    self.reset()
+
+  def close(self):
+    """Unregister from the scheduler: call it once the worker loop stops"""
+    self.scheduler.unregister(self)
+
+  def reset(self):
+    """Back to polling often: call it when the queue had items"""
+    self.interval = min(self.scheduler.min_interval, self.max_interval)
+
+  def backoff(self):
+    """Schedule the next probe, then double the interval (up to `max_interval`)"""
+    self.due = time.monotonic() + self.scheduler.jittered(self.interval)
+    self.interval = min(2 * self.interval, self.max_interval)
+
+  async def wait(self, sub: Subscriber) -> list[str] | None:
+    """Wait until a notification arrives on `sub` (returning its keys) or a probe finds free items in the queue (returning `None`)"""
+    self._woken.clear()
+    self.backoff()
+    self.scheduler.kick(self.db)
+    try:
+      idx, keys = await race([self._woken.wait(), sub.wait()])
+    finally:
+      self.due = None
+    if idx == 1:
+      self.reset()
+      return keys # type: ignore
+    return None
+
+@dataclass(eq=False)
+class _Group:
+  """Pollers sharing a DB engine, probed together"""
+  pollers: list[Poller] = field(default_factory=list)
+  kicked: asyncio.Event = field(default_factory=asyncio.Event)
+  task: asyncio.Task | None = None
+
+@dataclass
+class Scheduler:
+  """Polls the queues of this process' worker loops, so that lost notifications are noticed soon, without hammering the DB when idle
+  - Each queue backs off exponentially (with `jitter`) from `min_interval` up to its pipeline's `poll_interval`, and is reset by notifications and claimed items
+  - Queues of a DB due within `window` seconds are probed together, in a single query (see `any_free`)
+  """
+  min_interval: float = 0.1
+  jitter: float = 0.2
+  window: float = 0.05
+  _groups: WeakKeyDictionary[Engine, _Group] = field(default_factory=WeakKeyDictionary, init=False, repr=False)
+
+  _current: ClassVar[WeakKeyDictionary[asyncio.AbstractEventLoop, 'Scheduler']] = WeakKeyDictionary()
+
+  @classmethod
+  def current(cls) -> 'Scheduler':
+    """The scheduler of the running event loop (and so, of this process)"""
+    loop = asyncio.get_running_loop()
+    if (scheduler := cls._current.get(loop)) is None:
+      scheduler = cls._current[loop] = cls()
+    return scheduler
+
+  def jittered(self, interval: float) -> float:
+    return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+  def register(self, db: DB, Table: type[SQLModel], *, where: Sequence[ColumnElement[bool]] = (), max_interval: float) -> Poller:
+    """Register a queue (with `key` and `ttl` columns), whose free items are those matching `where`.
+    Unregister it with `Poller.close`
+    """
+    poller = Poller(self, db, Table, where, max_interval)
+    self._group(db).pollers.append(poller)
+    return poller
+
+  def unregister(self, poller: Poller):
+    """Stop probing `poller`'s queue. The last poller of a DB stops its probe task"""
+    group = self._groups.get(poller.db.engine)
+    if group is None or poller not in group.pollers:
+      return
+    group.pollers.remove(poller)
+    if not group.pollers:
+      del self._groups[poller.db.engine]
+      if group.task is not None:
+        group.task.cancel()
+
+  def _group(self, db: DB) -> _Group:
+    if (group := self._groups.get(db.engine)) is None:
+      group = self._groups[db.engine] = _Group()
+    return group
+
+  def kick(self, db: DB):
+    """Reconsider when to probe `db`'s queues (e.g. a poller started waiting)"""
+    group = self._group(db)
+    if group.task is None or group.task.done():
+      group.task = asyncio.create_task(self._probe_loop(group))
+    group.kicked.set()
+
+  async def _probe_loop(self, group: _Group):
+    while True:
+      group.kicked.clear()
+      now = time.monotonic()
+      waiting = [p for p in group.pollers if p.due is not None]
+      due = [p for p in waiting if p.due <= now + self.window] # type: ignore
+      if not due:
+        timeout = min((p.due for p in waiting), default=now + 60) - now # type: ignore
+        try:
+          await asyncio.wait_for(group.kicked.wait(), timeout)
+        except asyncio.TimeoutError:
+          ...
+        continue
+
+      db = due[0].db # all on the same engine
+      try:
+        with tagged(phase='probe'):
+          found = await db.run(any_free, db.engine, [(p.Table, p.where) for p in due])
+      except Exception: # let the loops run into it, and report it
+        found = [True] * len(due)
+
+      for poller, free in zip(due, found):
+        if poller.due is None: # woken by a notification meanwhile
+          continue
+        if free:
+          poller.due = None
+          poller._woken.set()
+        else:
+          poller.backoff()
@@ -0,0 +1,304 @@
+from typing_extensions import Any, Protocol, Literal
+from dataclasses import dataclass, field
+from collections import OrderedDict
+import json
+import zlib
+from uuid import uuid4
+from sqlmodel import SQLModel, Field, Session, select, or_
+from sqlalchemy import Index, insert, delete, update, LargeBinary, TypeDecorator
+from sqlalchemy.orm import declared_attr
+from sqltypes import ValidatedJSON
+from pipeteer.backend import DB, Codec
+from pipeteer.pipelines import Inputtable
+from .pipeline import memo_type
+from ._bulk import chunks
+
+AnyT: type = Any # type: ignore
+StateStorage = Literal['rows', 'packed', 'packed-binary']
+
+_MISSING: Any = object()
+
+@dataclass
+class Step:
+  """A workflow step, as stored, plus the values decoded by replays (memoized across them)"""
+  pipeline: str
+  param: Any
+  result: Any = None
+  done: bool = False
+  x: Any = field(default=_MISSING, repr=False) # last param known to match `param`
+  y: Any = field(default=_MISSING, repr=False) # decoded `result`
+  generation: str | None = field(default=None, repr=False) # token of the stored history, on its first step (see `StateStore.load`)
+
+  def matches(self, pipe: Inputtable, x) -> bool:
+    try:
+      if self.x is not _MISSING and self.x == x:
+        return True
+    except Exception:
+      ...
+    if pipe.input_adapter.dump_python(x) == self.param:
+      self.x = x
+      return True
+    return False
+
+  def output(self, pipe: Inputtable):
+    if self.y is _MISSING:
+      self.y = pipe.output_adapter.validate_python(self.result)
+    return self.y
+
+  def dump(self) -> dict:
+    return dict(pipeline=self.pipeline, param=self.param, result=self.result, done=self.done)
+
+@dataclass
+class Steps:
+  """LRU cache of workflow histories (`key -> steps`), kept by a worker across replays"""
+  size: int
+  cache: OrderedDict[str, list[Step]] = field(default_factory=OrderedDict)
+
+  def pop(self, key: str) -> list[Step]:
+    return self.cache.pop(key, [])
+
+  def put(self, key: str, steps: list[Step]):
+    if self.size > 0:
+      self.cache[key] = steps
+      if len(self.cache) > self.size:
+        self.cache.popitem(last=False)
+
+def _merge(cached: list[Step], start: int, loaded: list[Step]) -> list[Step]:
+  """`cached[:start] + loaded`, carrying over the params memoized in `cached`"""
+  steps = cached[:start]
+  for i, step in enumerate(loaded, start):
+    if i < len(cached) and cached[i].pipeline == step.pipeline:
+      step.x = cached[i].x
+    steps.append(step)
+  return steps
+
+def _finished(steps: list[Step]) -> int:
+  return next((i for i, step in enumerate(steps) if not step.done), len(steps))
+
+def _generation(steps: list[Step]) -> str | None:
+  return steps[0].generation if steps else None
+
+
+class StateStore(Protocol):
+  """Where a workflow keeps the history of each key"""
+  def load(self, s: Session, key: str, cached: list[Step] = []) -> list[Step]:
+    """Steps of `key`, in order. Only steps after the finished prefix of `cached` need be read from the DB.
+    Each history gets a random generation when its first step is added, so that a cache of a cleared (e.g. restarted) history isn't reused
+    """
+  def append(self, s: Session, key: str, steps: list[Step]):
+    """Add `steps[-1]`, the newly called step"""
+  def extend(self, s: Session, key: str, steps: list[Step], start: int):
+    """Add `steps[start:]`, called together (e.g. by `ctx.map`)"""
+  def finish(self, s: Session, key: str, steps: list[Step], n: int):
+    """Store the result of the `n`-th step (`steps[n]`, already marked as done)"""
+  def resolve(self, s: Session, key: str, n: int, result: Any) -> str | None:
+    """Store `result` as the `n`-th step's, without loading the steps, if it's still pending. Returns the step's pipeline, if it was"""
+  def clear(self, s: Session, key: str):
+    ...
+  def last(self, s: Session, key: str) -> int | None:
+    """Index of the last step of `key`, if any"""
+  def pending(self, s: Session, key: str, *, besides: int | None = None) -> bool:
+    """Whether some step of `key` (other than the `besides`-th) is not done yet"""
+
+
+class State(SQLModel):
+  key: str = Field(primary_key=True)
+  step: int = Field(primary_key=True)
+  param: Any = Field(sa_type=ValidatedJSON(AnyT))
+  result: Any | None = Field(default=None, sa_type=ValidatedJSON(AnyT))
+  done: bool = False
+  pipeline: str
+
+  @declared_attr # type: ignore
+  def __table_args__(cls):
+    return (Index(f'ix_{cls.__tablename__}_pending', 'key', 'done', 'step'),)
+
+@dataclass
+class RowStates(StateStore):
+  """One `State` row per step. The history's generation is kept in a row of its own, at step `-1`"""
+  State: type[State]
+
+  def load(self, s: Session, key: str, cached: list[Step] = []) -> list[Step]:
+    State = self.State
+    start = _finished(cached)
+    rows = s.exec(select(State).where(State.key == key, or_(State.step < 0, State.step >= start)).order_by(State.step)).all() # type: ignore
+    generation = rows[0].param if rows and rows[0].step < 0 else None
+    rows = rows[generation is not None:]
+    if (
+      generation != _generation(cached) or (start < len(cached) and not rows)
+      or any(row.step != start+i for i, row in enumerate(rows))
+    ):
+      # stale cache (e.g. the workflow was restarted)
+      start, cached = 0, []
+      rows = s.exec(select(State).where(State.key == key, State.step >= 0).order_by(State.step)).all() # type: ignore
+
+    steps = _merge(cached, start, [Step(row.pipeline, row.param, row.result, row.done) for row in rows])
+    if steps:
+      steps[0].generation = generation
+    return steps
+
+  def _generation_row(self, key: str, steps: list[Step]) -> dict:
+    """Row of a new history's generation, given its first steps"""
+    steps[0].generation = uuid4().hex
+    return dict(key=key, step=-1, param=steps[0].generation, result=None, done=True, pipeline='')
+
+  def append(self, s: Session, key: str, steps: list[Step]):
+    step = steps[-1]
+    if len(steps) == 1:
+      s.add(self.State(**self._generation_row(key, steps)))
+    s.add(self.State(key=key, step=len(steps)-1, param=step.param, pipeline=step.pipeline))
+
+  def extend(self, s: Session, key: str, steps: list[Step], start: int):
+    rows = [
+      dict(key=key, step=i, param=step.param, result=None, done=False, pipeline=step.pipeline)
+      for i, step in enumerate(steps[start:], start)
+    ]
+    if start == 0 and steps:
+      rows.insert(0, self._generation_row(key, steps))
+    for chunk in chunks(rows, 1000):
+      s.execute(insert(self.State), chunk)
+
+  def finish(self, s: Session, key: str, steps: list[Step], n: int):
+    State = self.State
+    stmt = update(State).where(State.key == key, State.step == n).values(done=True, result=steps[n].result) # type: ignore
+    s.exec(stmt.execution_options(synchronize_session=False)) # type: ignore[call-overload]
+
+  def resolve(self, s: Session, key: str, n: int, result: Any) -> str | None:
+    State = self.State
+    stmt = update(State).where(State.key == key, State.step == n, State.done == False).values(done=True, result=result) # type: ignore
+    if s.exec(stmt.execution_options(synchronize_session=False)).rowcount == 0: # type: ignore[call-overload]
+      return None
+    return s.exec(select(State.pipeline).where(State.key == key, State.step == n)).one()
+
+  def clear(self, s: Session, key: str):
+    s.exec(delete(self.State).where(self.State.key == key)) # type: ignore[call-overload]
+
+  def last(self, s: Session, key: str) -> int | None:
+    State = self.State
+    state = s.exec(select(State).where(State.key == key, State.step >= 0).order_by(State.step.desc())).first() # type: ignore
+    if state:
+      return state.step
+
+  def pending(self, s: Session, key: str, *, besides: int | None = None) -> bool:
+    State = self.State
+    stmt = select(State.step).where(State.key == key, State.done == False) # type: ignore
+    if besides is not None:
+      stmt = stmt.where(State.step != besides)
+    return s.exec(stmt.limit(1)).first() is not None
+
+
+class CompressedJSON(TypeDecorator):
+  """JSON, deflated into a binary column"""
+  impl = LargeBinary
+  cache_ok = True
+
+  def process_bind_param(self, value, dialect):
+    if value is not None:
+      return zlib.compress(json.dumps(value, separators=(',', ':')).encode())
+
+  def process_result_value(self, value, dialect):
+    if value is not None:
+      return json.loads(zlib.decompress(value))
+
+class History(SQLModel):
+  key: str = Field(primary_key=True)
+  steps: list[dict[str, Any]] = Field(default_factory=list, sa_type=ValidatedJSON(list[dict[str, Any]]))
+  generation: str = Field(default_factory=lambda: uuid4().hex)
+
+class BinaryHistory(SQLModel):
+  key: str = Field(primary_key=True)
+  steps: list[dict[str, Any]] = Field(default_factory=list, sa_type=CompressedJSON)
+  generation: str = Field(default_factory=lambda: uuid4().hex)
+
+@memo_type
+def state_model(codec: Codec | None = None) -> type[State]:
+  if codec is None:
+    return State
+  class EncodedState(State):
+    param: Any = Field(sa_type=codec.column(AnyT))
+    result: Any | None = Field(default=None, sa_type=codec.column(AnyT))
+  return EncodedState
+
+@memo_type
+def history_model(codec: Codec | None = None) -> type[History]:
+  if codec is None:
+    return History
+  class EncodedHistory(History):
+    steps: list[dict[str, Any]] = Field(default_factory=list, sa_type=codec.column(list[dict[str, Any]]))
+  return EncodedHistory
+
+@dataclass
+class PackedStates(StateStore):
+  """All steps of a key in a single row: reads are a single primary-key fetch, cleanup a single delete"""
+  History: type[History] | type[BinaryHistory]
+
+  def load(self, s: Session, key: str, cached: list[Step] = []) -> list[Step]:
+    row = s.get(self.History, key)
+    stored, generation = (row.steps, row.generation) if row else ([], None)
+    start = _finished(cached)
+    if len(stored) < start or generation != _generation(cached):
+      # stale cache (e.g. the workflow was restarted)
+      start, cached = 0, []
+    steps = _merge(cached, start, [Step(**step) for step in stored[start:]])
+    if steps:
+      steps[0].generation = generation
+    return steps
+
+  def _locked(self, s: Session, key: str) -> History | None:
+    """The row of `key`, read after locking it, so that concurrent updates (e.g. results of `ctx.all`) don't overwrite each other.
+    Locked by a no-op update: SQLite ignores `FOR UPDATE`, and only takes the write lock on the first write
+    """
+    History = self.History
+    s.exec(update(History).where(History.key == key).values(key=History.key)) # type: ignore[call-overload]
+    return s.get(History, key, populate_existing=True)
+
+  def append(self, s: Session, key: str, steps: list[Step]):
+    row = self._locked(s, key) or self.History(key=key)
+    row.steps = [*row.steps, steps[-1].dump()]
+    steps[0].generation = row.generation
+    s.add(row)
+
+  def extend(self, s: Session, key: str, steps: list[Step], start: int):
+    row = self._locked(s, key) or self.History(key=key)
+    row.steps = [*row.steps, *(step.dump() for step in steps[start:])]
+    if steps:
+      steps[0].generation = row.generation
+    s.add(row)
+
+  def finish(self, s: Session, key: str, steps: list[Step], n: int):
+    if (row := self._locked(s, key)) is not None:
+      stored = list(row.steps)
+      stored[n] = steps[n].dump()
+      row.steps = stored
+      s.add(row)
+
+  def resolve(self, s: Session, key: str, n: int, result: Any) -> str | None:
+    row = self._locked(s, key)
+    if row is None or n >= len(row.steps) or row.steps[n].get('done'):
+      return None
+    stored = list(row.steps)
+    stored[n] = stored[n] | dict(done=True, result=result)
+    row.steps = stored
+    s.add(row)
+    return stored[n]['pipeline']
+
+  def clear(self, s: Session, key: str):
+    s.exec(delete(self.History).where(self.History.key == key)) # type: ignore[call-overload]
+
+  def last(self, s: Session, key: str) -> int | None:
+    if (row := s.get(self.History, key)) is not None and row.steps:
+      return len(row.steps) - 1
+
+  def pending(self, s: Session, key: str, *, besides: int | None = None) -> bool:
+    row = s.get(self.History, key)
+    return row is not None and any(not step.get('done') for i, step in enumerate(row.steps) if i != besides)
+
+
+def state_store(db: DB, id: str, storage: StateStorage) -> StateStore:
+  if storage == 'rows':
+    return RowStates(db.table(id + '-states', state_model(db.codec)))
+  elif storage == 'packed':
+    return PackedStates(db.table(id + '-history', history_model(db.codec)))
+  elif storage == 'packed-binary':
+    return PackedStates(db.table(id + '-history', BinaryHistory))
+  raise ValueError(f'Unknown state storage: "{storage}"')
@@ -1,8 +1,14 @@
-from typing_extensions import TypeVar, Generic, Callable, Any, Awaitable, Protocol
+from typing_extensions import TypeVar, Generic, Callable, Any, Awaitable, Protocol, Mapping, Iterable
 from dataclasses import dataclass
-from sqlmodel import Session
+from collections import defaultdict
+from datetime import datetime
+from sqlmodel import Session, select
+from sqlalchemy import delete
 from pipeteer.pipelines import Pipeline, Context, Entry, InputT
 from pipeteer.util import param_type, type_arg, num_params, Func2or3
+from ._bulk import OnConflict, chunks, hints, insert_stmt, items_of
+from ._tracing import record
+from pipeteer.backend.profiler import tagged
 
 A = TypeVar('A')
 B = TypeVar('B')
@@ -14,6 +20,69 @@ Artifact = TypeVar('Artifact')
 class Push(Protocol, Generic[D]):
   async def __call__(self, key: str, val: D) -> bool:
     ...
+  async def many(self, items: Mapping[str, D] | Iterable[tuple[str, D]], /, *, on_conflict: OnConflict = 'error') -> int:
+    """Push many outputs in a single transaction, notifying each output table once.
+    Returns how many were pushed (keys without a pending input are skipped)
+    - `on_conflict`: what to do with keys already in their output table: `'error'` (pushing nothing), `'ignore'` or `'replace'` them
+    """
+    ...
+
+@dataclass
+class TaskPush(Push[B], Generic[A, B]):
+  Input: type[InputT[A]]
+  Tout: type[B]
+  ctx: Context
+  chunk_size: int = 1000
+  id: str | None = None
+  """Task's id, for tracing (see `Context.trace`)"""
+
+  async def __call__(self, key: str, val: B) -> bool:
+    ctx = self.ctx
+    def write() -> str | None:
+      with Session(ctx.db.engine) as s:
+        if (inp := s.get(self.Input, key)) is None:
+          return None
+        out = inp.output
+        Output = ctx.db.table(out, Entry(self.Tout, ctx.db.codec))
+        s.add(Output(key=key, value=val))
+        s.delete(inp)
+        if ctx.trace and self.id is not None:
+          record(s, ctx.db, self.id, [key], finished=datetime.now())
+        s.commit()
+        return out
+    
+    with tagged(pipeline=self.id, phase='output'):
+      out = await ctx.db.write(write)
+    if out is None:
+      return False
+    await ctx.notify(out, [key])
+    return True
+  
+  async def many(self, items: Mapping[str, B] | Iterable[tuple[str, B]], /, *, on_conflict: OnConflict = 'error') -> int:
+    ctx, Input = self.ctx, self.Input
+    pushed: dict[str, list[str]] = defaultdict(list) # output -> keys
+    def write():
+      with Session(ctx.db.engine) as s:
+        for chunk in chunks(items_of(items), self.chunk_size):
+          vals = dict(chunk)
+          inps = s.exec(select(Input.key, Input.output).where(Input.key.in_(list(vals)))).all() # type: ignore
+          outputs: dict[str, list[str]] = defaultdict(list)
+          for key, out in inps:
+            outputs[out].append(key)
+          for out, keys in outputs.items():
+            Output = ctx.db.table(out, Entry(self.Tout, ctx.db.codec))
+            s.execute(insert_stmt(s, Output, on_conflict), [dict(key=key, value=vals[key]) for key in keys])
+            pushed[out].extend(keys)
+            if ctx.trace and self.id is not None:
+              record(s, ctx.db, self.id, keys, finished=datetime.now())
+          s.exec(delete(Input).where(Input.key.in_([key for key, _ in inps]))) # type: ignore[call-overload]
+        s.commit()
+
+    with tagged(pipeline=self.id, phase='output'):
+      await ctx.db.write(write)
+    for out, keys in pushed.items():
+      await ctx.notify(out, hints(keys))
+    return sum(len(keys) for keys in pushed.values())
 
 @dataclass
 class Task(Pipeline[A, B, Ctx, Artifact], Generic[A, B, Ctx, Artifact]):
@@ -21,20 +90,7 @@ class Task(Pipeline[A, B, Ctx, Artifact], Generic[A, B, Ctx, Artifact]):
 
   def run(self, ctx: Ctx, /):
     Input = self.input(ctx)
-    async def push(key: str, val: B):
-      with Session(ctx.db.engine) as s:
-        if (inp := s.get(Input, key)) is None:
-          return False
-        else:
-          out = inp.output
-          Output = ctx.db.table(out, Entry(self.Tout))
-          s.add(Output(key=key, value=val))
-          s.delete(inp)
-          s.commit()
-      
-      await ctx.zmq.pub.send(out)
-      return True
-
+    push = TaskPush(Input, self.Tout, ctx, id=self.id)
     return self.call(Input, push, ctx)
 
 def task(id: str | None = None):
@@ -0,0 +1,117 @@
+from typing_extensions import Iterable, Sequence
+from collections import defaultdict
+from datetime import datetime
+from sqlmodel import SQLModel, Field, Session, select
+from pipeteer.backend import DB
+from ._bulk import insert_stmt, defaults
+
+class Span(SQLModel):
+  """When an item went through each stage of a pipeline (recorded if `Context.trace` is set)
+  - `key`: `'{pipeline}:{item}'`
+  - `parent`: span of the workflow that called the pipeline (for workflow steps, `item` is `'{step}_{workflow key}'`)
+  - `resumed`: when the parent workflow picked up the result, to replay
+  """
+  key: str = Field(primary_key=True)
+  pipeline: str
+  item: str
+  parent: str | None = Field(default=None, index=True)
+  enqueued: datetime | None = None
+  claimed: datetime | None = None
+  finished: datetime | None = None
+  resumed: datetime | None = None
+
+def spans(db: DB) -> type[Span]:
+  return db.table('pipeteer-spans', Span)
+
+def span_key(pipeline: str, item: str) -> str:
+  return f'{pipeline}:{item}'
+
+def record(s: Session, db: DB, pipeline: str, items: Iterable[str], *, parent: str | None = None, **times: datetime | None):
+  """Upsert the spans of `pipeline`'s `items` within `s`, setting `times` (e.g. `claimed=...`) and `parent` (if given). Other fields are kept"""
+  Spans = spans(db)
+  values = dict(times) | ({} if parent is None else dict(parent=parent))
+  base = defaults(Spans)
+  rows = [base | values | dict(key=span_key(pipeline, item), pipeline=pipeline, item=item) for item in items]
+  if rows:
+    s.execute(insert_stmt(s, Spans, 'replace', columns=list(values)), rows)
+
+def enqueued(s: Session, db: DB, pipeline: str, items: Iterable[str], *, parent: str | None = None):
+  """Start the spans of `items` over (they may have been traced before, e.g. if restarted)"""
+  record(s, db, pipeline, items, parent=parent, enqueued=datetime.now(), claimed=None, finished=None, resumed=None)
+
+
+async def timeline(db: DB, pipeline: str, key: str) -> list[tuple[int, Span]]:
+  """Spans of `pipeline`'s `key` and its descendants (e.g. a workflow's steps, and theirs), depth-first in enqueue order, with their depth"""
+  Spans = spans(db)
+  def read():
+    out: list[tuple[int, Span]] = []
+    with Session(db.engine) as s:
+      def visit(span: Span, depth: int):
+        out.append((depth, span))
+        children = s.exec(select(Spans).where(Spans.parent == span.key)).all()
+        for child in sorted(children, key=lambda c: c.enqueued or datetime.min):
+          visit(child, depth+1)
+      if (root := s.get(Spans, span_key(pipeline, key))) is not None:
+        visit(root, 0)
+    return out
+  return await db.run(read)
+
+def hops(span: Span, children: Sequence[Span] = ()) -> dict[str, list[float]]:
+  """Durations (in seconds) of each hop of `span`:
+  - `queue`: waiting in the input queue, until claimed (including poll gaps)
+  - `run`: from claimed to finished (for activities, the call plus commit; for workflows, everything in between)
+  - `resume`: until the parent workflow picked the result up
+  - `total`: from enqueued to finished
+  - `replay`: (workflows) from resuming (or first claiming) to calling the next step (or finishing), given the workflow's `children` spans
+  """
+  out: dict[str, list[float]] = defaultdict(list)
+  def add(hop: str, start: datetime | None, end: datetime | None):
+    if start is not None and end is not None and end >= start:
+      out[hop].append((end - start).total_seconds())
+
+  add('queue', span.enqueued, span.claimed)
+  add('run', span.claimed, span.finished)
+  add('resume', span.finished, span.resumed)
+  add('total', span.enqueued, span.finished)
+  if children:
+    children = sorted(children, key=lambda c: c.enqueued or datetime.min)
+    add('replay', span.claimed, children[0].enqueued)
+    for prev, curr in zip(children, children[1:]):
+      add('replay', prev.resumed, curr.enqueued)
+    add('replay', children[-1].resumed, span.finished)
+  return out
+
+async def latencies(
+  db: DB, *, since: datetime | None = None, percentiles: Sequence[float] = (50, 90, 99),
+) -> dict[str, dict[str, dict[str, float]]]:
+  """Percentiles of each hop's duration (see `hops`), per pipeline: `{pipeline: {hop: {'n', 'mean', 'p50', ...}}}`
+  - `since`: only spans enqueued since then
+  """
+  Spans = spans(db)
+  def read() -> Sequence[Span]:
+    with Session(db.engine) as s:
+      stmt = select(Spans)
+      if since is not None:
+        stmt = stmt.where(Spans.enqueued >= since) # type: ignore
+      return s.exec(stmt).all()
+
+  rows = await db.run(read)
+  children: dict[str, list[Span]] = defaultdict(list)
+  for span in rows:
+    if span.parent is not None:
+      children[span.parent].append(span)
+
+  durations: dict[str, dict[str, list[float]]] = defaultdict(lambda: defaultdict(list))
+  for span in rows:
+    for hop, xs in hops(span, children.get(span.key, ())).items():
+      durations[span.pipeline][hop].extend(xs)
+
+  def stats(xs: list[float]) -> dict[str, float]:
+    xs = sorted(xs)
+    ps = { f'p{p:g}': xs[min(len(xs)-1, int(p/100 * len(xs)))] for p in percentiles }
+    return dict(n=len(xs), mean=sum(xs) / len(xs)) | ps
+
+  return {
+    pipeline: { hop: stats(xs) for hop, xs in hops_.items() }
+    for pipeline, hops_ in durations.items()
+  }
@@ -1,15 +1,24 @@
-from typing_extensions import TypeVar, Generic, Callable, Awaitable, Any, Protocol, overload, Coroutine
-from dataclasses import dataclass
+from typing_extensions import TypeVar, Generic, Callable, Awaitable, Any, Protocol, overload, Coroutine, Iterable, Sequence
+from dataclasses import dataclass, field
 import asyncio
+import inspect
 from datetime import timedelta, datetime
 import traceback
-from sqlmodel import SQLModel, Field, select, Session, or_
-from sqlalchemy import delete
-from pydantic import TypeAdapter
+from sqlmodel import Field, Session
+from sqlalchemy import delete, update
+from sqlalchemy.orm import declared_attr
 from sqltypes import ValidatedJSON
+from pipeteer.backend import Codec
+from pipeteer.backend.metrics import timed, Every
+from pipeteer.backend.profiler import tagged
 from pipeteer.pipelines import Pipeline, Inputtable, Context, Input, Entry, InputT, EntryT
-from pipeteer.util import param_type, return_type, race
-from .pipeline import A
+from pipeteer.util import param_type, return_type
+from .pipeline import A, memo_type
+from ._claim import Hints, claim_indexes, DEPTH_INTERVAL, queue_depth
+from ._states import Step, Steps, State, StateStore, StateStorage, state_store, state_model
+from ._tracing import record, enqueued, span_key
+from ._bulk import chunks, defaults, insert_stmt, hints
+from ._scheduler import Scheduler, Poller
 
 Aw = Awaitable
 # A = TypeVar('A')
@@ -32,21 +41,29 @@ class WorkflowContext(Protocol):
   async def all(self, a: Aw[A], b: Aw[B], c: Aw[C], d: Aw[D], /) -> tuple[A, B, C, D]: ...
   @overload
   async def all(self, *coros: Aw[A]) -> tuple[A, ...]: ...
+  async def map(self, pipe: Inputtable[A, B], xs: Iterable[A], /, *, chunk_size: int | None = None) -> list[B]:
+    """Call `pipe` on each of `xs` (like `all`, but enqueued in bulk)
+    - `chunk_size`: max calls in flight: each chunk is enqueued once the previous one is done. All at once by default
+    """
+    ...
 
 @dataclass
 class WkfContext(WorkflowContext):
   ctx: Context
-  session: Session
-  State: type['State']
-  states: list['State']
+  store: StateStore
+  states: list[Step]
   key: str
   output: str
   step: int = 0
+  span: str | None = None
+  """The workflow's span, parent of its steps' (if tracing)"""
+  _group: list[tuple[Inputtable, Any]] | None = field(default=None, init=False, repr=False)
+  """Calls of the branches of `all`, while calling them"""
 
   async def call(self, pipe: Inputtable[A, B], x: A, /) -> B:
     if self.step < len(self.states):
       state = self.states[self.step]
-      if pipe.input_adapter.dump_python(x) != state.param:
+      if not state.matches(pipe, x):
         param = pipe.input_adapter.validate_python(state.param)
         self.ctx.log(f'Impure workflow. At step {self.step}, calling "{pipe.id}": expected "{param}" but got "{x}"', level='ERROR')
         raise RuntimeError('Impure workflow')
@@ -54,21 +71,18 @@ class WkfContext(WorkflowContext):
       self.ctx.log(f'Replaying {pipe.id}, step={self.step}, key="{self.key}"', level='DEBUG')
 
       self.step += 1
-      return pipe.output_adapter.validate_python(state.result)
+      return state.output(pipe)
     
+    elif self._group is not None: # within `all`: enqueued together with the other branches
+      self._group.append((pipe, x))
+      raise Stop()
+
     else:
       self.ctx.log(f'Calling {pipe.id}, step={self.step}, key="{self.key}"', level='DEBUG')
-      PipeInp = pipe.input(self.ctx)
-      with Session(self.ctx.db.engine) as s:
-        s.add(PipeInp(key=f'{self.step}_{self.key}', value=x, output=self.output))
-        s.add(self.State(key=self.key, step=self.step, param=x, pipeline=pipe.id))
-        s.commit()
-      await self.ctx.zmq.pub.send(pipe.id)
-
-      self.step += 1
-      raise Stop()
+      await self._enqueue([(pipe, x)])
     
   async def all(self, *coros: Awaitable): # type: ignore
+    """Call all branches, then resume once all of their results are in (the results loop holds the replay until then)"""
     n = len(coros)
     if self.step + n-1 < len(self.states):
       self.ctx.log(f'Replaying all, step={self.step}, key="{self.key}"', level='DEBUG')
@@ -76,38 +90,108 @@ class WkfContext(WorkflowContext):
     
     elif self.step == len(self.states):
       self.ctx.log(f'Calling all, step={self.step}, key="{self.key}"', level='DEBUG')
+      group, self._group = self._group, []
+      try:
+        for coro in coros:
+          try:
+            await coro
+          except Stop:
+            ...
+        calls = self._group
+      finally:
+        self._group = group
+      # in a single transaction: a branch's result can't arrive before the others are called
+      await self._enqueue(calls)
+    else: # replayed while the branches were still being called
+      called = len(self.states) - self.step
+      self.ctx.log(f'Ignoring all (called {called}/{n}), step={self.step}, key="{self.key}"', level='DEBUG')
       for coro in coros:
-        try:
-          await coro
-        except Stop:
-          ...
-    else:
-      received = self.step+n+1 - len(self.states)
-      self.ctx.log(f'Ignoring all (received {received}/{n}), step={self.step}, key="{self.key}"', level='DEBUG')
+        if inspect.iscoroutine(coro):
+          coro.close()
+    raise Stop()
+
+  async def map(self, pipe: Inputtable[A, B], xs: Iterable[A], /, *, chunk_size: int | None = None) -> list[B]:
+    xs = list(xs)
+    size = chunk_size or len(xs) or 1
+    outs: list[B] = []
+    for start in range(0, len(xs), size):
+      chunk = xs[start:start+size]
+      if self.step + len(chunk) <= len(self.states):
+        self.ctx.log(f'Replaying map of {pipe.id}, steps={self.step}..{self.step+len(chunk)-1}, key="{self.key}"', level='DEBUG')
+        for x in chunk:
+          state = self.states[self.step]
+          if not state.matches(pipe, x):
+            self.ctx.log(f'Impure workflow. At step {self.step}, mapping "{pipe.id}": expected "{state.param}" but got "{x}"', level='ERROR')
+            raise RuntimeError('Impure workflow')
+          outs.append(state.output(pipe))
+          self.step += 1
+
+      elif self.step == len(self.states):
+        self.ctx.log(f'Mapping {pipe.id} over {len(chunk)} items, step={self.step}, key="{self.key}"', level='DEBUG')
+        await self._enqueue([(pipe, x) for x in chunk])
+      else:
+        self.ctx.log(f'Impure workflow. At step {self.step}, mapping {len(chunk)} items over "{pipe.id}", but {len(self.states)} steps were called', level='ERROR')
+        raise RuntimeError('Impure workflow')
+    return outs
+
+  async def _enqueue(self, calls: Sequence[tuple[Inputtable, Any]]):
+    """Enqueue `calls` as the next steps, in a single transaction (notifying each pipeline once), then stop"""
+    start = self.step
+    groups: dict[str, tuple[Inputtable, list[tuple[str, Any]]]] = {}
+    for i, (pipe, x) in enumerate(calls, start):
+      self.states.append(Step(pipe.id, param=pipe.input_adapter.dump_python(x, mode='json'), x=x))
+      groups.setdefault(pipe.id, (pipe, []))[1].append((f'{i}_{self.key}', x))
+
+    def write():
+      with Session(self.ctx.db.engine) as s:
+        for pipe, items in groups.values():
+          PipeInp = pipe.input(self.ctx)
+          base = defaults(PipeInp) | dict(output=self.output)
+          stmt = insert_stmt(s, PipeInp)
+          for chunk in chunks(items, 1000):
+            s.execute(stmt, [base | dict(key=key, value=x) for key, x in chunk])
+          if self.span is not None:
+            enqueued(s, self.ctx.db, pipe.id, [key for key, _ in items], parent=self.span)
+        self.store.extend(s, self.key, self.states, start)
+        s.commit()
+
+    with tagged(phase='call'):
+      await self.ctx.db.write(write)
+    for id, (_, items) in groups.items():
+      await self.ctx.notify(id, hints([key for key, _ in items]))
+
+    self.step += len(calls)
     raise Stop()
-  
-class State(SQLModel):
-  key: str = Field(primary_key=True)
-  step: int = Field(primary_key=True)
-  param: Any = Field(sa_type=ValidatedJSON(AnyT))
-  result: Any | None = Field(default=None, sa_type=ValidatedJSON(AnyT))
-  done: bool = False
-  pipeline: str
   
 class WkfInputT(InputT[A], Generic[A]):
   doing: bool = False
 
-def WkfInput(T: type[A]) -> type[WkfInputT[A]]:
-  Inp = Input(T)
+@memo_type
+def WkfInput(T: type[A], codec: Codec | None = None) -> type[WkfInputT[A]]:
+  Inp = Input(T, codec)
   class WkfInput(Inp):
     doing: bool = False
+
+    @declared_attr # type: ignore
+    def __table_args__(cls):
+      return claim_indexes(cls.__tablename__, 'doing')
+    
   return WkfInput # type: ignore
 
 
-class Result(EntryT):
-  value: Any = Field(sa_type=ValidatedJSON(AnyT))
+class ResultT(EntryT):
   ttl: datetime | None = None
 
+  @declared_attr # type: ignore
+  def __table_args__(cls):
+    return claim_indexes(cls.__tablename__)
+
+@memo_type
+def Result(codec: Codec | None = None) -> type[ResultT]:
+  class Result(ResultT):
+    value: Any = Field(sa_type=ValidatedJSON(AnyT) if codec is None else codec.column(AnyT))
+  return Result
+
 @dataclass
 class Workflow(Pipeline[A, B, Context, Coroutine], Generic[A, B]):
   Input = WkfInput
@@ -115,16 +199,22 @@ class Workflow(Pipeline[A, B, Context, Coroutine], Generic[A, B]):
   call: Callable[[A, WorkflowContext], Awaitable[B]]
   reserve: timedelta | None = None
   poll_interval: timedelta = timedelta(seconds=1)
+  claim_batch: int = 1
+  replay_cache: int = 0
+  state_storage: StateStorage = 'rows'
 
   def states(self, ctx: Context):
-    return ctx.db.table(self.id + '-states', State)
+    return ctx.db.table(self.id + '-states', state_model(ctx.db.codec))
+  
+  def store(self, ctx: Context) -> StateStore:
+    return state_store(ctx.db, self.id, self.state_storage)
   
   def input(self, ctx: Context):
-    return ctx.db.table(self.id, WkfInput(self.Tin))
+    return ctx.db.table(self.id, WkfInput(self.Tin, ctx.db.codec))
   
   def results(self, ctx: Context):
     output = self.id + '-results'
-    table = ctx.db.table(output, Result)
+    table = ctx.db.table(output, Result(ctx.db.codec))
     return output, table
   
   def run(self, ctx: Context) -> Coroutine:
@@ -140,109 +230,246 @@ class Workflow(Pipeline[A, B, Context, Coroutine], Generic[A, B]):
 
       output, Result = self.results(ctx)
       Input = self.input(ctx)
-      State = self.states(ctx)
+      store = self.store(ctx)
+      cache = Steps(self.replay_cache)
+      metrics = ctx.metrics
+
+      def load(key: str, cached: list[Step] = []) -> list[Step]:
+        with Session(ctx.db.engine) as s:
+          return store.load(s, key, cached)
 
-      async def run(*, key: str, results_key: str | None = None, input, states: list['State'] = [], s: Session):
-        wkf_ctx = WkfContext(ctx, session=s, State=State, states=states, key=key, output=output)
+      async def run(
+        *, key: str, results_key: str | None = None, input, steps: list[Step],
+        trace: Callable[[Session], None],
+      ):
+        """Replay the workflow. `trace` records this hop's spans in the final write, if it finishes"""
+        span = span_key(self.id, key) if ctx.trace else None
+        wkf_ctx = WkfContext(ctx, store=store, states=steps, key=key, output=output, span=span)
         ctx.log(f'Rerunning "{key}"', level='DEBUG')
-        input = TypeAdapter(self.Tin).validate_python(input)
-        out = await self.call(input, wkf_ctx)
-        
-        item = s.get(Input, key)
-        if item is None:
-          raise ValueError(f'Input item "{key}" not found')
+        input = self.input_adapter.validate_python(input)
+        with timed(metrics, 'pipeteer_call_seconds', pipeline=self.id):
+          out = await self.call(input, wkf_ctx)
         
-        ctx.log(f'Outputting "{key}" to "{item.output}"', level='DEBUG')
-        Output = ctx.db.table(item.output, Entry(self.Tout))
-        s.add(Output(key=key, value=out))
-        s.exec(delete(State).where(State.key == key)) # type: ignore[call-overload]
-        s.exec(delete(Input).where(Input.key == key)) # type: ignore[call-overload]
-        if results_key is not None:
-          s.exec(delete(Result).where(Result.key == results_key)) # type: ignore[call-overload]
+        def write() -> str:
+          with Session(ctx.db.engine) as s:
+            item = s.get(Input, key)
+            if item is None:
+              raise ValueError(f'Input item "{key}" not found')
+            
+            ctx.log(f'Outputting "{key}" to "{item.output}"', level='DEBUG')
+            Output = ctx.db.table(item.output, Entry(self.Tout, ctx.db.codec))
+            s.add(Output(key=key, value=out))
+            store.clear(s, key)
+            s.exec(delete(Input).where(Input.key == key)) # type: ignore[call-overload]
+            if results_key is not None:
+              s.exec(delete(Result).where(Result.key == results_key)) # type: ignore[call-overload]
+            if span is not None:
+              trace(s)
+              record(s, ctx.db, self.id, [key], finished=datetime.now())
+            s.commit()
+            return item.output
 
-        s.commit()
-        await ctx.zmq.pub.send(item.output)
+        with timed(metrics, 'pipeteer_commit_seconds', pipeline=self.id), tagged(phase='output'):
+          out_table = await ctx.db.write(write)
+        await ctx.notify(out_table, [key])
         
-      async def input_step(inp: WkfInputT, s: Session):
+      async def input_step(inp: WkfInputT, claimed_at: datetime):
         ctx.log(f'Input loop: "{inp.key}"', level='DEBUG')
+        cache.pop(inp.key)
+        steps = []
+        def trace(s: Session):
+          record(s, ctx.db, self.id, [inp.key], claimed=claimed_at)
         try:
-          await run(key=inp.key, input=inp.value, s=s)
+          await run(key=inp.key, input=inp.value, steps=steps, trace=trace)
         except Stop:
-          inp.doing = True
-          s.add(inp)
-          s.commit()
+          def write():
+            with Session(ctx.db.engine) as s:
+              s.exec(update(Input).where(Input.key == inp.key).values(doing=True)) # type: ignore[call-overload]
+              if ctx.trace:
+                trace(s)
+              s.commit()
+          with timed(metrics, 'pipeteer_commit_seconds', pipeline=self.id), tagged(phase='state'):
+            await ctx.db.write(write)
+          cache.put(inp.key, steps)
 
-      async def results_step(inp: EntryT, s: Session):
+      async def results_step(inp: EntryT):
+        resumed_at = datetime.now()
         i, key = inp.key.split('_', 1)
         i = int(i)
         ctx.log(f'Results loop: "{key}", step={i}', level='DEBUG')
 
-        if not (input := s.get(Input, key)):
-          return
+        def read():
+          with Session(ctx.db.engine) as s:
+            if (input := s.get(Input, key)) is None:
+              return None
+            if store.pending(s, key, besides=i):
+              return input.value, None
+            return input.value, store.load(s, key, cache.pop(key))
         
-        states = s.exec(select(State).where(State.key == key)).all()
-        states = sorted(states, key=lambda state: state.step)
-        if not states or states[-1].done:
+        with tagged(phase='load'):
+          loaded = await ctx.db.run(read)
+        if loaded is None:
           return
-        
-        state = states[-1]
-        state.done = True
-        state.result = inp.value
-        s.add(state)
+        value, steps = loaded
+        results_key: str | None = inp.key
 
-        try:
-          await run(key=key, results_key=inp.key, input=input.value, states=states, s=s)
-          
-        except Stop:
-          s.delete(inp)
-          s.commit()
+        if steps is None:
+          # fan-in barrier (`ctx.all`, `ctx.map`): other steps are pending, so just store the result (without loading the steps).
+          # The workflow is replayed once, by the group's last result
+          def store_result() -> bool:
+            with Session(ctx.db.engine) as s:
+              s.get(Input, key, with_for_update=True) # one result of `key` at a time (SQLite serializes writes anyway)
+              pipeline = store.resolve(s, key, i, inp.value)
+              s.exec(delete(Result).where(Result.key == inp.key)) # type: ignore[call-overload]
+              if pipeline is not None and ctx.trace:
+                record(s, ctx.db, pipeline, [inp.key], resumed=resumed_at)
+              last = pipeline is not None and not store.pending(s, key)
+              s.commit()
+              return last
+          with timed(metrics, 'pipeteer_commit_seconds', pipeline=self.id), tagged(phase='state'):
+            last = await ctx.db.write(store_result)
+          if not last:
+            return
+          # the others arrived meanwhile (on other workers)
+          with tagged(phase='load'):
+            steps = await ctx.db.run(load, key, cache.pop(key))
+          results_key = None
 
+        def trace(s: Session):
+          record(s, ctx.db, steps[i].pipeline, [inp.key], resumed=resumed_at)
+
+        if results_key is not None:
+          if i >= len(steps) or steps[i].done:
+            # duplicate, or from before a restart
+            def discard():
+              with Session(ctx.db.engine) as s:
+                s.exec(delete(Result).where(Result.key == inp.key)) # type: ignore[call-overload]
+                s.commit()
+            with tagged(phase='state'):
+              await ctx.db.write(discard)
+            return
+          steps[i].done = True
+          steps[i].result = inp.value
 
-      async def input_loop():
-        sub = ctx.zmq.sub(self.id)
         while True:
+          metrics.inc('pipeteer_replays_total', pipeline=self.id)
+          metrics.inc('pipeteer_replayed_steps_total', len(steps), pipeline=self.id)
+          called = len(steps)
           try:
+            await run(key=key, results_key=results_key, input=value, steps=steps, trace=trace)
+            return
+          except Stop:
+            ...
+
+          # written after the replay, in a session of its own: the replay's calls would wait on this one's lock
+          def write() -> bool:
+            """Returns whether the replay stalled: it called nothing, yet nothing is pending
+            (the results it waits for were stored meanwhile, by other workers, which left the replay to this one)"""
+            waiting = len(steps) == called
             with Session(ctx.db.engine) as s:
-              free = or_(Input.ttl == None, Input.ttl < datetime.now()) # type: ignore
-              inp = s.exec(select(Input).where(Input.doing == False, free)).first()
-              if inp is None:
-                await race([
-                  asyncio.sleep(self.poll_interval.total_seconds()),
-                  sub.wait()
-                ])
+              if waiting:
+                s.get(Input, key, with_for_update=True) # like `store_result`
+              if results_key is not None:
+                store.finish(s, key, steps, i)
+                s.exec(delete(Result).where(Result.key == results_key)) # type: ignore[call-overload]
+                if ctx.trace:
+                  trace(s)
+              stalled = waiting and not store.pending(s, key)
+              s.commit()
+              return stalled
+          with timed(metrics, 'pipeteer_commit_seconds', pipeline=self.id), tagged(phase='state'):
+            stalled = await ctx.db.write(write)
+          if not stalled:
+            cache.put(key, steps)
+            return
+          with tagged(phase='load'):
+            steps = await ctx.db.run(load, key)
+          results_key = None
+
+      async def claim(Table, hints: Hints, sample: Every, poller: Poller, queue: str, where=()):
+        labels = dict(pipeline=self.id, queue=queue)
+        if metrics.enabled and sample():
+          with tagged(phase='depth'):
+            metrics.set('pipeteer_queue_depth', await ctx.db.run(queue_depth, ctx.db.engine, Table), **labels)
+        with timed(metrics, 'pipeteer_claim_seconds', **labels), tagged(phase='claim'):
+          rows = await ctx.db.write(lambda: hints.claim(
+            ctx.db.engine, Table, self.claim_batch, reserve=self.reserve, where=where
+          ))
+        metrics.inc('pipeteer_claims_total', len(rows), **labels)
+        if rows:
+          poller.reset()
+        if hints.expired:
+          metrics.inc('pipeteer_lease_expirations_total', hints.expired, **labels)
+          hints.expired = 0
+        return rows
+
+
+      async def input_loop():
+        sub = ctx.zmq.sub(self.id)
+        hints, sample = Hints(), Every(DEPTH_INTERVAL)
+        where = [Input.doing == False] # type: ignore
+        poller = Scheduler.current().register(ctx.db, Input, where=where, max_interval=self.poll_interval.total_seconds())
+        try:
+          while True:
+            try:
+              inps = await claim(Input, hints, sample, poller, 'input', where=where)
+              claimed_at = datetime.now()
+              if not inps:
+                if (keys := await poller.wait(sub)) is not None:
+                  metrics.inc('pipeteer_notifications_received_total', topic=self.id)
+                  hints.add(keys)
                 continue
-              elif self.reserve:
-                inp.ttl = datetime.now() + self.reserve
-                s.commit()
-            
-              await input_step(inp, s)
-          except:
-            ctx.log('Error in input loop', traceback.format_exc(), level='ERROR')
-            await asyncio.sleep(self.poll_interval.total_seconds())
+            except Exception:
+              metrics.inc('pipeteer_errors_total', pipeline=self.id, stage='claim')
+              ctx.log('Error in input loop', traceback.format_exc(), level='ERROR')
+              await asyncio.sleep(self.poll_interval.total_seconds())
+              continue
+
+            for inp in inps:
+              try:
+                await input_step(inp, claimed_at)
+              except Exception:
+                metrics.inc('pipeteer_errors_total', pipeline=self.id, stage='input')
+                ctx.log(f'Error in input loop, key="{inp.key}"', traceback.format_exc(), level='ERROR')
+        finally:
+          poller.close()
 
 
       async def results_loop():
         sub = ctx.zmq.sub(output)
-        while True:
-          try:
-            with Session(ctx.db.engine) as s:
-              inp = s.exec(select(Result)).first()
-              if inp is None:
-                await race([
-                  asyncio.sleep(self.poll_interval.total_seconds()),
-                  sub.wait()
-                ])
+        hints, sample = Hints(), Every(DEPTH_INTERVAL)
+        poller = Scheduler.current().register(ctx.db, Result, max_interval=self.poll_interval.total_seconds())
+        try:
+          while True:
+            try:
+              inps = await claim(Result, hints, sample, poller, 'results')
+              if not inps:
+                if (keys := await poller.wait(sub)) is not None:
+                  metrics.inc('pipeteer_notifications_received_total', topic=output)
+                  hints.add(keys)
                 continue
-              elif self.reserve:
-                inp.ttl = datetime.now() + self.reserve
-                s.commit()
-            
-              await results_step(inp, s)
-          except:
-            ctx.log('Error in results loop', traceback.format_exc(), level='ERROR')
-            await asyncio.sleep(self.poll_interval.total_seconds())
+            except Exception:
+              metrics.inc('pipeteer_errors_total', pipeline=self.id, stage='claim')
+              ctx.log('Error in results loop', traceback.format_exc(), level='ERROR')
+              await asyncio.sleep(self.poll_interval.total_seconds())
+              continue
 
-      await asyncio.gather(input_loop(), results_loop())
+            for inp in inps:
+              try:
+                await results_step(inp)
+              except Exception:
+                metrics.inc('pipeteer_errors_total', pipeline=self.id, stage='results')
+                ctx.log(f'Error in results loop, key="{inp.key}"', traceback.format_exc(), level='ERROR')
+        finally:
+          poller.close()
+
+      if not await ctx.zmq.ready(): # claim only once notifications get through, so none is lost in between
+        ctx.log('Subscription not confirmed (is the proxy running?). Relying on polls', level='WARNING')
+      try:
+        with tagged(pipeline=self.id):
+          await asyncio.gather(input_loop(), results_loop())
+      finally:
+        await ctx.zmq.flush()
 
     return loop()
   
@@ -250,42 +477,67 @@ class Workflow(Pipeline[A, B, Context, Coroutine], Generic[A, B]):
   async def delete(self, ctx: Context, key: str):
     """Delete a workflow by key"""
     Inp = self.input(ctx)
-    State = self.states(ctx)
+    store = self.store(ctx)
     _, Result = self.results(ctx)
-    with Session(ctx.db.engine) as s:
-      s.exec(delete(State).where(State.key == key)) # type: ignore[call-overload]
-      s.exec(delete(Result).where(Result.key == key)) # type: ignore[call-overload]
-      s.exec(delete(Inp).where(Inp.key == key)) # type: ignore[call-overload]
-      s.commit()
+    def write():
+      with Session(ctx.db.engine) as s:
+        store.clear(s, key)
+        s.exec(delete(Result).where(Result.key == key)) # type: ignore[call-overload]
+        s.exec(delete(Inp).where(Inp.key == key)) # type: ignore[call-overload]
+        s.commit()
+    await ctx.db.write(write)
 
   async def restart(self, ctx: Context, key: str):
     """Restart a workflow by key"""
     Inp = self.input(ctx)
-    State = self.states(ctx)
+    store = self.store(ctx)
     _, Result = self.results(ctx)
-    with Session(ctx.db.engine) as s:
-      if (inp := s.get(Inp, key)):
-        inp.doing = False
-        inp.ttl = None
-        s.add(inp)
-        s.exec(delete(State).where(State.key == key)) # type: ignore[call-overload]
-        s.exec(delete(Result).where(Result.key == key)) # type: ignore[call-overload]
-        s.commit()
-        await ctx.zmq.pub.send(self.id)
+    def write() -> bool:
+      with Session(ctx.db.engine) as s:
+        if (inp := s.get(Inp, key)):
+          inp.doing = False
+          inp.ttl = None
+          s.add(inp)
+          store.clear(s, key)
+          s.exec(delete(Result).where(Result.key == key)) # type: ignore[call-overload]
+          s.commit()
+          return True
+        return False
+
+    if await ctx.db.write(write):
+      await ctx.notify(self.id, [key])
 
   async def step(self, ctx: Context, key: str) -> int | None:
     """At which step is the workflow?"""
-    State = self.states(ctx)
-    with Session(ctx.db.engine) as s:
-      state = s.exec(select(State).where(State.key == key).order_by(State.step.desc())).first() # type: ignore
-      if state:
-        return state.step
+    store = self.store(ctx)
+    def read():
+      with Session(ctx.db.engine) as s:
+        return store.last(s, key)
+    return await ctx.db.run(read)
 
 def workflow(
   *, id: str | None = None,
   reserve: timedelta | None = timedelta(minutes=2),
-  poll_interval: timedelta = timedelta(minutes=2),
+  poll_interval: timedelta = timedelta(seconds=10),
+  claim_batch: int = 1,
+  replay_cache: int = 0,
+  state_storage: StateStorage = 'rows',
 ):
+  """
+  - `reserve`: how long a claimed item is leased before other workers may retry it
+  - `poll_interval`: max time between polls of the input queues, when idle. Polls back off up to it, and notifications wake the worker earlier (see `Scheduler`)
+  - `claim_batch`: max number of items leased per round trip to each queue
+  - `replay_cache`: number of workflows whose history is kept in memory (LRU) across replays.
+    Cached steps are read once from the DB and decoded once, so a new result costs about the same regardless of the step count.
+    Replayed results are then shared across replays: don't mutate them in place.
+  - `state_storage`: how each workflow's history is stored
+    - `'rows'`: one row per step
+    - `'packed'`: a single JSON row per workflow, so reads are one primary-key fetch and cleanup a single delete
+    - `'packed-binary'`: like `'packed'`, deflated into a binary column
+  """
+  if claim_batch < 1:
+    raise ValueError(f'claim_batch must be at least 1, got {claim_batch}')
+
   def decorator(fn: Callable[[A, WorkflowContext], Awaitable[B]]) -> Workflow[A, B]:
     Tin = param_type(fn)
     if Tin is None:
@@ -301,5 +553,8 @@ def workflow(
       call=fn, # type: ignore
       reserve=reserve,
       poll_interval=poll_interval,
+      claim_batch=claim_batch,
+      replay_cache=replay_cache,
+      state_storage=state_storage,
     ) # type: ignore	
   return decorator
\ No newline at end of file
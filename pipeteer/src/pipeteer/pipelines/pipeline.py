@@ -1,36 +1,95 @@
-from typing_extensions import TypeVar, Generic, Self, Any, AsyncIterable
+from typing_extensions import TypeVar, Generic, Self, Any, AsyncIterable, Callable, Sequence, Mapping, Iterable, Literal
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field, replace, KW_ONLY
 from datetime import datetime
-from functools import cached_property
-from sqlmodel import SQLModel, Field, select
+from functools import cached_property, wraps
+from sqlmodel import SQLModel, Field, Session, select
+from sqlalchemy import ColumnElement
+from sqlalchemy.orm import declared_attr
 from pydantic import TypeAdapter
 from sqltypes import ValidatedJSON
 from dslog import Logger
-from pipeteer.backend import DB, ZMQ
+from pipeteer.backend import DB, ZMQ, Local, Notifier, Transport, Codec, Metrics, NoMetrics
+from pipeteer.backend.profiler import tagged
+from ._claim import claim_indexes
+from ._bulk import OnConflict, MAX_HINTS, chunks, defaults, insert_stmt, hints, items_of
+from ._tracing import enqueued, spans
 
 AnyT: type = Any # type: ignore
 A = TypeVar('A')
+T = TypeVar('T', bound=SQLModel)
+LeaseState = Literal['free', 'leased', 'expired']
 B = TypeVar('B')
 Artifact = TypeVar('Artifact', covariant=True)
+F = TypeVar('F', bound=Callable)
+
+def memo_type(factory: F) -> F:
+  """Cache a model factory by its (hashable) arguments, so equal calls return the same model class"""
+  cache = {}
+  @wraps(factory)
+  def wrapper(*args):
+    try:
+      if (cls := cache.get(args)) is None:
+        cls = cache[args] = factory(*args)
+      return cls
+    except TypeError: # unhashable type
+      return factory(*args)
+  return wrapper # type: ignore
 
 @dataclass
 class Context:
   db: DB
-  zmq: ZMQ
+  zmq: Notifier
   _: KW_ONLY
   log: Logger = field(default_factory=Logger.click)
+  metrics: Metrics = field(default_factory=NoMetrics)
+  trace: bool = False
 
-  async def wait(self, topic: str, /):
-    await self.zmq.sub(topic).wait()
+  def __post_init__(self):
+    if self.trace:
+      spans(self.db) # create it upfront: not within the transactions that write to it
+
+  async def wait(self, topic: str, /) -> list[str]:
+    """Wait for a notification on `topic`. Returns the keys it hints (possibly none)"""
+    keys = await self.zmq.sub(topic).wait()
+    self.metrics.inc('pipeteer_notifications_received_total', topic=topic)
+    return keys
+
+  async def notify(self, topic: str, keys: Sequence[str] = (), /):
+    """Notify `topic`, optionally hinting the `keys` just written to it"""
+    await self.zmq.pub.send(topic, keys)
+    self.metrics.inc('pipeteer_notifications_sent_total', topic=topic)
 
   @classmethod
   def of(
     cls, db: DB, *, log: Logger = Logger.click(),
     pub_url: str = 'tcp://localhost:5555',
     sub_url: str = 'tcp://localhost:5556',
+    coalesce: float | None = None,
+    transport: Transport = 'tcp',
+    metrics: Metrics | None = None,
+    trace: bool = False,
   ):
-    return cls(db, ZMQ(pub_url=pub_url, sub_url=sub_url), log=log)
+    """
+    - `coalesce`: window (in seconds) in which notifications of the same topic are merged into one (`0`: within an event loop tick).
+      Useful when bursts of writes would otherwise send thousands of identical wake-ups. `None` (default) sends each right away
+    - `transport`: how notifications travel
+      - `'tcp'`: through a proxy at `pub_url` -> `sub_url` (see `pipeteer proxy`), across processes and machines
+      - `'inproc'`: ZMQ sockets within this process, without proxy
+      - `'local'`: in-memory asyncio queues, without sockets. Only for pipelines running in this process
+    - `metrics`: where pipelines report their metrics (e.g. a `Registry`, exposed over HTTP with `Registry.serve`). Discarded by default
+    - `trace`: record when each item is enqueued, claimed and finished (and workflow steps, resumed) in the `pipeteer-spans` table,
+      within the transactions that already do so. See `timeline` and `latencies`. Needs SQLite or Postgres
+    """
+    if transport == 'tcp':
+      zmq = ZMQ(pub_url=pub_url, sub_url=sub_url, coalesce=coalesce)
+    elif transport == 'inproc':
+      zmq = ZMQ.inproc(coalesce=coalesce)
+    elif transport == 'local':
+      zmq = Local(coalesce=coalesce)
+    else:
+      raise ValueError(f'Unknown transport: "{transport}"')
+    return cls(db, zmq, log=log, metrics=metrics or NoMetrics(), trace=trace)
 
   def prefix(self, prefix: str) -> Self:
     return replace(self, log=self.log.prefix(prefix))
@@ -47,19 +106,25 @@ class EntryT(SQLModel, Generic[A]):
     cls.__args__ = (type,) # type: ignore
     return cls # type: ignore
 
-def Entry(type: type[A]) -> type[EntryT[A]]:
+@memo_type
+def Entry(type: type[A], codec: Codec | None = None) -> type[EntryT[A]]:
   class Entry(EntryT[type]):
-    value: type = Field(sa_type=ValidatedJSON(type, name='JSON'))
+    value: type = Field(sa_type=ValidatedJSON(type, name='JSON') if codec is None else codec.column(type))
   return Entry
 
 class InputT(EntryT[A], Generic[A]):
   ttl: datetime | None = None
   output: str = 'output'
 
+  @declared_attr # type: ignore
+  def __table_args__(cls):
+    return claim_indexes(cls.__tablename__)
 
-def Input(type: type[A]) -> type[InputT[A]]:
+
+@memo_type
+def Input(type: type[A], codec: Codec | None = None) -> type[InputT[A]]:
   class Input(InputT[type]):
-    value: type = Field(sa_type=ValidatedJSON(type, name='JSON'))
+    value: type = Field(sa_type=ValidatedJSON(type, name='JSON') if codec is None else codec.column(type))
   return Input
 
 @dataclass
@@ -80,21 +145,91 @@ class Inputtable(TypesMixin[A, B], Generic[A, B]):
   id: str
 
   def input(self, ctx: Context) -> type[InputT[A]]:
-    return ctx.db.table(self.id, Input(self.Tin)) # type: ignore
+    return ctx.db.table(self.id, Input(self.Tin, ctx.db.codec)) # type: ignore
   
   def output(self, ctx: Context, table: str = 'output') -> type[EntryT[B]]:
-    return ctx.db.table(table, Entry(self.Tout))
+    return ctx.db.table(table, Entry(self.Tout, ctx.db.codec))
   
-  async def notify(self, ctx: Context):
-    await ctx.zmq.pub.send(self.id)
+  async def notify(self, ctx: Context, keys: Sequence[str] = ()):
+    """Wake up the workers. `keys` optionally hints which items were pushed, so they're fetched by primary key"""
+    await ctx.notify(self.id, keys)
 
-  async def items(self, ctx: Context) -> AsyncIterable[InputT[A]]:
+  async def push_many(
+    self, ctx: Context, items: Mapping[str, A] | Iterable[tuple[str, A]], *,
+    output: str = 'output', on_conflict: OnConflict = 'error', chunk_size: int = 1000,
+  ):
+    """Insert `items` (`key -> value`) into the input queue in a single transaction, then notify the workers once
+    - `output`: table the outputs will be written to
+    - `on_conflict`: what to do with keys already in the queue: `'error'` (inserting nothing), `'ignore'` or `'replace'` them
+    - `chunk_size`: rows per (`executemany`) round trip
+    """
     Inp = self.input(ctx)
-    with ctx.db.session as s:
-      for it in s.exec(select(Inp)):
-        yield it
+    base = defaults(Inp) | dict(output=output)
+    keys: list[str] = []
+    def write():
+      with ctx.db.session as s:
+        stmt = insert_stmt(s, Inp, on_conflict)
+        for chunk in chunks(items_of(items), chunk_size):
+          s.execute(stmt, [base | dict(key=key, value=value) for key, value in chunk])
+          if ctx.trace:
+            enqueued(s, ctx.db, self.id, [key for key, _ in chunk])
+          if len(keys) <= MAX_HINTS:
+            keys.extend(key for key, _ in chunk)
+        s.commit()
+
+    with tagged(pipeline=self.id, phase='push'):
+      await ctx.db.write(write)
+    await ctx.notify(self.id, hints(keys))
+
+  async def items(
+    self, ctx: Context, *, state: LeaseState | None = None, page_size: int = 1000
+  ) -> AsyncIterable[InputT[A]]:
+    """Stream the input queue, in `key` order
+    - `state`: only items never claimed (`'free'`), currently claimed (`'leased'`) or whose lease has run out (`'expired'`)
+    - `page_size`: items read per query (see `paginate`)
+    """
+    Inp = self.input(ctx)
+    now = datetime.now()
+    where = {
+      None: [],
+      'free': [Inp.ttl == None], # type: ignore
+      'leased': [Inp.ttl >= now], # type: ignore
+      'expired': [Inp.ttl < now], # type: ignore
+    }[state]
+    async for it in paginate(ctx.db, Inp, where=where, page_size=page_size):
+      yield it
+  
+  async def outputs(self, ctx: Context, table: str = 'output', *, page_size: int = 1000) -> AsyncIterable[EntryT[B]]:
+    """Stream the output table `table`, in `key` order (see `paginate`)"""
+    async for it in paginate(ctx.db, self.output(ctx, table), page_size=page_size):
+      yield it
   
 
+async def paginate(
+  db: DB, Table: type[T], *,
+  where: Sequence[ColumnElement[bool]] = (),
+  page_size: int = 1000,
+) -> AsyncIterable[T]:
+  """Stream the rows of `Table` (which must have a `key` primary key) by keyset pagination, in `key` order
+  - Each page is read in its own short session, on the DB's threads (see `DB.run`)
+  - Rows are detached, with all their attributes loaded
+  """
+  def read(last) -> Sequence[T]:
+    with Session(db.engine) as s:
+      stmt = select(Table).where(*where)
+      if last is not None:
+        stmt = stmt.where(Table.key > last) # type: ignore
+      return s.exec(stmt.order_by(Table.key).limit(page_size)).all() # type: ignore
+
+  last = None
+  while True:
+    page = await db.run(read, last)
+    for row in page:
+      yield row
+    if len(page) < page_size:
+      return
+    last = page[-1].key # type: ignore
+
 @dataclass
 class Runnable(ABC, TypesMixin[A, B], Generic[A, B, Ctx, Artifact]):
   id: str
@@ -9,9 +9,11 @@ async def race(coros: Iterable[Coroutine[Any, Any, A]]) -> tuple[int, A]:
     return idx, await coro
   
   tasks = [asyncio.create_task(enum_task(i, c)) for i, c in enumerate(coros)]
-  done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-  for task in pending:
-    task.cancel()
+  try:
+    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+  finally: # also if the race itself is cancelled
+    for task in tasks:
+      task.cancel()
   return done.pop().result()
 
 